@@ -23,22 +23,24 @@ class User(Model):
 
 class Blog(Model):
     __table__ = 'blogs'
+    __shard_key__ = 'user_id'
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    user_id = StringField(updatable=False, ddl='varchar(50)')
+    user_id = StringField(updatable=False, ddl='varchar(50)', references='User')
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
     name = StringField(ddl='varchar(50)')
     summary = StringField(ddl='varchar(200)')
-    content = TextField()
+    content = TextField(deferred=True)
     create_at = FloatField(updatable=False, defualt=time.time)
 
 class Comment(Model):
     __table__ = 'comments'
+    __shard_key__ = 'user_id'
 
     id = StringField(primary_key=True, defualt=next_id, ddl='varchar(50)')
-    blog_id = StringField(updatable=False, ddl='varchar(50)')
-    user_id = StringField(updatable=False, ddl='varchar(50)')
+    blog_id = StringField(updatable=False, ddl='varchar(50)', references='Blog')
+    user_id = StringField(updatable=False, ddl='varchar(50)', references='User')
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(dl='varchar(500)')
     content = TextField()
@@ -0,0 +1,117 @@
+#coding:utf8
+
+'''
+测试用的mysql.connector替身，用sqlite实现，只覆盖transwarp.db用到的接口
+    connect(database_path=...)  每个连接打开同一个sqlite文件，database_path缺省为DB['path']
+    LOG                         执行过的(sql, 参数)，用于检查发出了哪些语句
+    on duplicate key update     改写成sqlite的on conflict do update
+    limit 18446744073709551615  改写成sqlite的limit -1
+'''
+
+import re
+import sqlite3
+
+DB = {'path': ':memory:'}
+LOG = []
+
+class Error(Exception):
+    pass
+
+InterfaceError = Error
+OperationalError = sqlite3.OperationalError
+
+_UPSERT = re.compile(r'on duplicate key update (.*)$', re.I)
+
+def _translate(sql):
+    #mysql的offset必须带limit，习惯写最大的无符号整数；sqlite的limit是有符号的，-1表示不限制
+    sql = sql.replace('limit 18446744073709551615', 'limit -1')
+    sql = _UPSERT.sub(lambda m: 'on conflict do update set ' + re.sub(r'values\(`(\w+)`\)', r'excluded.`\1`', m.group(1)), sql)
+    return sql.replace('%s', '?')
+
+def _param(v):
+    #sqlite只接受ascii的str（而且在\0处截断），二进制数据用buffer传入
+    if isinstance(v, str) and re.search(r'[\x00\x80-\xff]', v):
+        return buffer(v)
+    return v
+
+def _concat(a, b):
+    if a is None:
+        return b
+    if isinstance(a, buffer) or isinstance(b, buffer):
+        return buffer(str(a) + str(b))
+    return a + b
+
+class Cursor(object):
+    def __init__(self, cursor, conn):
+        self._c = cursor
+        self._conn = conn
+
+    def execute(self, sql, args=()):
+        self._conn._check()
+        LOG.append((sql, tuple(args)))
+        self._c.execute(_translate(sql), tuple([_param(a) for a in args]))
+
+    def executemany(self, sql, seq):
+        self._conn._check()
+        seq = [tuple([_param(a) for a in args]) for args in seq]
+        LOG.append((sql, 'many'))
+        self._c.executemany(_translate(sql), seq)
+
+    @property
+    def description(self):
+        return self._c.description
+
+    @property
+    def rowcount(self):
+        return self._c.rowcount
+
+    @property
+    def lastrowid(self):
+        return self._c.lastrowid
+
+    def fetchone(self):
+        return self._c.fetchone()
+
+    def fetchall(self):
+        return self._c.fetchall()
+
+    def fetchmany(self, n=1):
+        return self._c.fetchmany(n)
+
+    def close(self):
+        self._c.close()
+
+class Connection(object):
+    opened = 0
+
+    def __init__(self, **kw):
+        self.kw = kw
+        self.closed = False
+        self.broken = False #为True时模拟断开的连接，ping和execute都会失败
+        self._c = sqlite3.connect(kw.get('database_path', DB['path']), check_same_thread=False)
+        self._c.create_function('concat', 2, _concat)
+        Connection.opened += 1
+
+    def _check(self):
+        if self.closed or self.broken:
+            raise Error('connection is not available')
+
+    def cursor(self, buffered=None, **kw):
+        self._check()
+        return Cursor(self._c.cursor(), self)
+
+    def commit(self):
+        self._c.commit()
+
+    def rollback(self):
+        self._c.rollback()
+
+    def ping(self, **kw):
+        self._check()
+
+    def close(self):
+        self.closed = True
+        self._c.close()
+
+def connect(**kw):
+    return Connection(**kw)
@@ -0,0 +1,55 @@
+#coding:utf8
+
+'''
+测试的公共部分：把sqlite实现的mysql.connector替身放到sys.path的最前面，
+每个测试用一个临时的数据库文件，结束时清掉db模块的全局状态
+运行：在www目录下 python -m unittest discover -s tests -t .
+'''
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+_here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(_here, 'shim'))
+sys.path.insert(0, os.path.dirname(_here))
+
+from mysql import connector
+from transwarp import db, orm
+
+def reset():
+    for e in [db.engine] + db.engines.values():
+        if e is not None:
+            e.pool.dispose()
+    db.engine = None
+    db.engines.clear()
+    db.set_replicas([])
+    db.set_shard_router(None)
+    db.reset_metrics()
+    db.disable_tracing()
+    orm.disable_query_cache()
+    del connector.LOG[:]
+
+class DBTestCase(unittest.TestCase):
+    '''
+    setUp中创建全局engine，self.path为主库文件，self.db_path(name)生成其他库的文件名
+    '''
+    engine_kw = {}
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = self.db_path('primary')
+        reset()
+        db.create_engine('u', 'p', 'test', database_path=self.path, **self.engine_kw)
+
+    def tearDown(self):
+        reset()
+        shutil.rmtree(self.dir)
+
+    def db_path(self, name):
+        return os.path.join(self.dir, '%s.db' % name)
+
+    def statements(self, prefix=''):
+        return [sql for sql, args in connector.LOG if sql.lower().startswith(prefix)]
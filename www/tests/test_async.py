@@ -0,0 +1,73 @@
+#coding:utf8
+
+import threading
+import unittest
+
+from support import DBTestCase
+from transwarp import db
+
+class AsyncTest(DBTestCase):
+
+    def setUp(self):
+        super(AsyncTest, self).setUp()
+        db.update('create table jobs (id integer primary key, name text)')
+        db.insert_many('jobs', [dict(id=i, name='j%d' % i) for i in range(5)])
+
+    def test_submit_runs_on_worker(self):
+        r = db.submit(lambda: threading.current_thread().name)
+        self.assertNotEqual(r.get(5), threading.current_thread().name)
+        self.assertEqual(db.aselect_int('select count(*) from jobs').get(5), 5)
+        self.assertEqual(db.aselect_one('select name from jobs where id=?', 2).get(5).name, 'j2')
+
+    def test_error_raised_by_get(self):
+        r = db.aselect('select * from no_such_table')
+        r.wait(5)
+        self.assertFalse(r.successful())
+        self.assertRaises(Exception, r.get, 5)
+
+    def test_gather(self):
+        rows, count, name = db.gather('select id from jobs order by id',
+                                      (db.select_int, 'select count(*) from jobs'),
+                                      lambda: db.select_one('select name from jobs where id=?', 3).name,
+                                      timeout=5)
+        self.assertEqual(([r.id for r in rows], count, name), (range(5), 5, 'j3'))
+
+    def test_nested_submit_does_not_deadlock(self):
+        #每个工作线程里再gather，原来会占满线程池并互相等待
+        def outer(i):
+            return sum(db.gather(('select count(*) from jobs where id<=?', i), (db.select_int, 'select ?', i), timeout=5)[1:])
+        results = [db.submit(outer, i) for i in range(db.ASYNC_WORKERS * 2)]
+        self.assertEqual([r.get(10) for r in results], range(db.ASYNC_WORKERS * 2))
+
+    def test_nested_submit_error(self):
+        def outer():
+            return db.submit(db.select, 'select * from no_such_table').get()
+        self.assertRaises(Exception, db.submit(outer).get, 5)
+
+    def test_atransaction(self):
+        def move(fail):
+            db.update('delete from jobs where id=?', 0)
+            if fail:
+                raise ValueError()
+        self.assertRaises(ValueError, db.atransaction(move, True).get, 5)
+        self.assertEqual(db.select_int('select count(*) from jobs'), 5)
+        db.atransaction(move, False).get(5)
+        self.assertEqual(db.select_int('select count(*) from jobs'), 4)
+
+    def test_using_carried_to_worker(self):
+        db.create_engine('u', 'p', 'test', database_path=self.db_path('other'), name='other')
+        with db.using('other'):
+            db.update('create table jobs (id integer primary key, name text)')
+            r = db.aselect_int('select count(*) from jobs')
+        self.assertEqual(r.get(5), 0)
+
+    def test_nested_on_shards(self):
+        for name in ('s0', 's1'):
+            db.create_engine('u', 'p', 'test', database_path=self.db_path(name), name=name)
+        def inner():
+            return db.select_int('select 1')
+        results = db.on_shards(lambda: db.on_shards(inner, ['s0', 's1'] * db.WORKERS), ['s0', 's1'] * db.WORKERS)
+        self.assertEqual(results, [[1] * db.WORKERS * 2] * db.WORKERS * 2)
+
+if __name__ == '__main__':
+    unittest.main()
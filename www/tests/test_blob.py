@@ -0,0 +1,121 @@
+#coding:utf8
+
+import io
+import unittest
+
+from support import DBTestCase
+from transwarp import db, orm
+from transwarp.orm import Model, StringField, BlobField
+
+DATA = ''.join([chr(i % 256) for i in range(1000)])
+
+class BlobFile(Model):
+    __table__ = 'files'
+
+    id = StringField(primary_key=True, ddl='varchar(50)')
+    data = BlobField()
+
+class _Broken(object):
+    '''
+    读出两块数据之后出错的文件
+    '''
+    def __init__(self):
+        self.n = 0
+
+    def readinto(self, buf):
+        self.n += 1
+        if self.n > 2:
+            raise IOError('broken')
+        buf[:] = 'x' * len(buf)
+        return len(buf)
+
+class BlobTest(DBTestCase):
+
+    def setUp(self):
+        super(BlobTest, self).setUp()
+        db.update('create table files (id text primary key, data blob)')
+        db.insert('files', id='a', data=DATA)
+        db.insert('files', id='empty', data=None)
+
+    def stored(self, id):
+        return str(db.select_one('select data from files where id=?', id).data)
+
+    def test_read_chunks(self):
+        reader = BlobFile.get('a', fields=['id']).open_blob('data', chunk_size=300)
+        self.assertEqual(reader.length(), 1000)
+        chunks = [str(c) for c in reader]
+        self.assertEqual([len(c) for c in chunks], [300, 300, 300, 100])
+        self.assertEqual(''.join(chunks), DATA)
+        self.assertEqual(''.join([str(c) for c in reader.chunks(900)]), DATA[900:])
+
+    def test_readinto(self):
+        reader = BlobFile(id='a').open_blob('data', chunk_size=64)
+        buf = bytearray(300)
+        self.assertEqual(reader.readinto(buf, 100), 300)
+        self.assertEqual(str(buf), DATA[100:400])
+        self.assertEqual(reader.readinto(buf, 900), 100)
+        self.assertEqual(str(buf[:100]), DATA[900:])
+
+    def test_copy_to(self):
+        f = io.BytesIO()
+        self.assertEqual(BlobFile(id='a').open_blob('data', chunk_size=128).copy_to(f), 1000)
+        self.assertEqual(f.getvalue(), DATA)
+
+    def test_write_in_chunks(self):
+        data = DATA[::-1]
+        with BlobFile(id='a').open_blob('data', 'w', chunk_size=64) as w:
+            w.write(data[:100])
+            w.write(bytearray(data[100:500]))
+            w.write(memoryview(data)[500:])
+        self.assertEqual(w.written, 1000)
+        self.assertEqual(self.stored('a'), data)
+        #每块一条update，最后不满一块的也是一条
+        self.assertEqual(len(self.statements('update')), 16)
+
+    def test_copy_from(self):
+        data = DATA[::-1]
+        with BlobFile(id='empty').open_blob('data', 'w', chunk_size=300) as w:
+            self.assertEqual(w.copy_from(io.BytesIO(data)), 1000)
+        self.assertEqual(self.stored('empty'), data)
+        self.assertEqual(BlobFile(id='empty').open_blob('data').length(), 1000)
+
+    def test_failed_write_rolls_back(self):
+        inst = BlobFile.get('a')
+        self.assertEqual(str(inst.data), DATA)
+        try:
+            with inst.open_blob('data', 'w', chunk_size=100) as w:
+                w.copy_from(_Broken())
+        except IOError:
+            pass
+        else:
+            self.fail('IOError expected')
+        self.assertEqual(len(self.statements('update')), 2)
+        self.assertEqual(self.stored('a'), DATA)
+        #实例上的旧值已经丢掉，重新加载
+        self.assertEqual(str(inst.data), DATA)
+
+    def test_write_missing_row(self):
+        w = BlobFile(id='nope').open_blob('data', 'w')
+        w.write('abc')
+        self.assertRaises(db.DBError, w.close)
+        self.assertEqual(db.select_int('select count(*) from files'), 2)
+
+    def test_blob_response(self):
+        calls = []
+        def start_response(status, headers):
+            calls.append((status, headers))
+        body = orm.blob_response(BlobFile(id='a'), 'data', start_response, 'image/png', [('Cache-Control', 'max-age=60')], chunk_size=256)
+        self.assertEqual(calls, [('200 OK', [('Content-Type', 'image/png'), ('Content-Length', '1000'), ('Cache-Control', 'max-age=60')])])
+        self.assertEqual(''.join([str(c) for c in body]), DATA)
+
+    def test_blob_response_not_found(self):
+        for id in ('nope', 'empty'):
+            calls = []
+            def start_response(status, headers):
+                calls.append(status)
+            body = orm.blob_response(BlobFile(id=id), 'data', start_response)
+            self.assertEqual(calls, ['404 Not Found'])
+            self.assertEqual(body, ['Not Found'])
+
+if __name__ == '__main__':
+    unittest.main()
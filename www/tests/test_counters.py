@@ -0,0 +1,88 @@
+#coding:utf8
+
+import unittest
+
+from support import DBTestCase, connector
+from transwarp import db, orm
+from transwarp.orm import Model, StringField
+
+class CountedItem(Model):
+    __table__ = 'counted_items'
+    __counters__ = ('*', 'group_id')
+
+    id = StringField(primary_key=True, ddl='varchar(50)')
+    group_id = StringField(ddl='varchar(50)')
+
+class CounterTest(DBTestCase):
+
+    def setUp(self):
+        super(CounterTest, self).setUp()
+        db.update(orm.COUNTERS_DDL)
+        db.update('create table counted_items (id text primary key, group_id text)')
+
+    def counts(self):
+        return (CountedItem.count_all(), CountedItem.count_of('group_id', 'a'), CountedItem.count_of('group_id', 'b'))
+
+    def test_insert(self):
+        CountedItem(id='1', group_id='a').insert()
+        CountedItem.insert_many([CountedItem(id=str(i), group_id='b') for i in range(2, 5)])
+        self.assertEqual(self.counts(), (4, 1, 3))
+
+    def test_count_by_reads_counter(self):
+        CountedItem(id='1', group_id='a').insert()
+        del connector.LOG[:]
+        self.assertEqual(CountedItem.count_by('where group_id=?', 'a'), 1)
+        self.assertEqual(self.statements('select count'), [])
+
+    def test_delete(self):
+        CountedItem.insert_many([CountedItem(id=str(i), group_id='a') for i in range(3)])
+        CountedItem.get('0').delete()
+        self.assertEqual(self.counts(), (2, 2, 0))
+        self.assertEqual(CountedItem.delete_where('where group_id=?', 'a'), 2)
+        self.assertEqual(self.counts(), (0, 0, 0))
+
+    def test_delete_many_ignores_missing(self):
+        CountedItem.insert_many([CountedItem(id=str(i), group_id='a') for i in range(3)])
+        CountedItem.delete_many(['1', 'missing'])
+        self.assertEqual(self.counts(), (2, 2, 0))
+
+    def test_update_moves_group(self):
+        CountedItem(id='1', group_id='a').insert()
+        inst = CountedItem.get('1')
+        inst.group_id = 'b'
+        inst.update()
+        self.assertEqual(self.counts(), (1, 0, 1))
+
+    def test_update_where(self):
+        CountedItem.insert_many([CountedItem(id=str(i), group_id='a') for i in range(4)])
+        CountedItem.update_where({'group_id': 'b'}, 'where id in (?,?)', '0', '1')
+        self.assertEqual(self.counts(), (4, 2, 2))
+        #已经是b的行不应再次计数
+        CountedItem.update_where({'group_id': 'b'}, 'where id in (?,?)', '1', '2')
+        self.assertEqual(self.counts(), (4, 1, 3))
+
+    def test_rolled_back_transaction(self):
+        try:
+            with db.transaction():
+                CountedItem(id='1', group_id='a').insert()
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(self.counts(), (0, 0, 0))
+
+    def test_session(self):
+        CountedItem(id='1', group_id='a').insert()
+        with orm.session():
+            CountedItem(id='2', group_id='b').insert()
+            CountedItem.get('1').delete()
+        self.assertEqual(self.counts(), (1, 0, 1))
+
+    def test_rebuild(self):
+        CountedItem.insert_many([CountedItem(id=str(i), group_id='a') for i in range(3)])
+        db.update("delete from counted_items where id='0'")
+        self.assertEqual(self.counts(), (3, 3, 0))
+        CountedItem.rebuild_counters()
+        self.assertEqual(self.counts(), (2, 2, 0))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,32 @@
+#coding:utf8
+
+import unittest
+
+from support import DBTestCase
+from transwarp import db
+
+class InsertManyTest(DBTestCase):
+
+    def setUp(self):
+        super(InsertManyTest, self).setUp()
+        db.update('create table notes (id integer, body text)')
+
+    def test_estimate_size_counts_utf8_bytes(self):
+        self.assertEqual(db._estimate_size(u'abc'), 6)
+        self.assertEqual(db._estimate_size(u'中文'), 9)
+        self.assertEqual(db._estimate_size('\xe4\xb8\xad'), 6)
+
+    def test_byte_budget_splits_statements(self):
+        rows = [dict(id=i, body=u'中' * 100) for i in range(10)]
+        #每行约 303+24+6 字节，每条语句3行；按字符数计算时每条能放8行
+        db.insert_many('notes', rows, max_bytes=1200)
+        self.assertEqual(len(self.statements('insert')), 4)
+        self.assertEqual(db.select_int('select count(*) from notes'), 10)
+
+    def test_max_rows(self):
+        db.insert_many('notes', [dict(id=i, body=u'x') for i in range(25)], max_rows=10)
+        self.assertEqual(len(self.statements('insert')), 3)
+        self.assertEqual(db.select_int('select count(*) from notes'), 25)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+#coding:utf8
+
+import unittest
+
+from support import DBTestCase, connector
+from transwarp import db
+
+class IterSelectTest(DBTestCase):
+
+    def setUp(self):
+        super(IterSelectTest, self).setUp()
+        db.update('create table numbers (n integer)')
+        db.update_many('insert into numbers values (?)', [(i,) for i in range(100)])
+
+    def test_all_rows(self):
+        rows = db.iter_select('select n from numbers order by n', batch_size=7)
+        self.assertEqual([r.n for r in rows], range(100))
+        s = db.pool_stats()
+        self.assertEqual((s.checked_out, s.closes), (0, 0))
+
+    def test_early_close_discards_connection(self):
+        fetched = []
+        orig = connector.Cursor.fetchmany
+        def fetchmany(cursor, n=1):
+            fetched.append(n)
+            return orig(cursor, n)
+        connector.Cursor.fetchmany = fetchmany
+        try:
+            rows = db.iter_select('select n from numbers order by n', batch_size=10)
+            self.assertEqual(rows.next().n, 0)
+            rows.close()
+        finally:
+            connector.Cursor.fetchmany = orig
+        #剩下的90行不会再读
+        self.assertEqual(len(fetched), 1)
+        s = db.pool_stats()
+        self.assertEqual((s.checked_out, s.idle, s.closes), (0, 0, 1))
+        self.assertEqual(db.select_int('select count(*) from numbers'), 100)
+
+    def test_early_close_in_transaction_keeps_connection(self):
+        with db.transaction():
+            rows = db.iter_select('select n from numbers order by n', batch_size=10)
+            rows.next()
+            rows.close()
+            db.update('insert into numbers values (?)', 100)
+        self.assertEqual(db.select_int('select count(*) from numbers'), 101)
+        self.assertEqual(db.pool_stats().closes, 0)
+
+if __name__ == '__main__':
+    unittest.main()
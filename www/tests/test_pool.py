@@ -0,0 +1,118 @@
+#coding:utf8
+
+import time
+import threading
+import unittest
+
+from support import DBTestCase, connector
+from transwarp import db
+
+class PoolTest(DBTestCase):
+
+    def pool(self, **kw):
+        return db._ConnectionPool(lambda: connector.connect(database_path=self.path), **kw)
+
+    def test_reuse(self):
+        pool = self.pool(max_size=2)
+        conn = pool.acquire()
+        pool.release(conn)
+        self.assertTrue(pool.acquire() is conn)
+        self.assertEqual(pool.stats().connects, 1)
+
+    def test_timeout(self):
+        pool = self.pool(max_size=1, max_overflow=0, timeout=0.1)
+        conn = pool.acquire()
+        start = time.time()
+        self.assertRaises(db.PoolTimeoutError, pool.acquire)
+        self.assertTrue(time.time() - start >= 0.1)
+        self.assertEqual(pool.stats().timeouts, 1)
+        pool.release(conn)
+        self.assertTrue(pool.acquire() is conn)
+
+    def test_acquire_without_waiting(self):
+        pool = self.pool(max_size=1, max_overflow=0, timeout=5)
+        conn = pool.acquire()
+        start = time.time()
+        self.assertRaises(db.PoolTimeoutError, pool.acquire, 0)
+        self.assertTrue(time.time() - start < 1)
+        pool.release(conn)
+        self.assertTrue(pool.acquire(0) is conn)
+
+    def test_wait_for_release(self):
+        pool = self.pool(max_size=1, max_overflow=0, timeout=5)
+        conn = pool.acquire()
+        t = threading.Timer(0.05, pool.release, (conn,))
+        t.start()
+        self.assertTrue(pool.acquire() is conn)
+        t.join()
+        self.assertEqual(pool.stats().waits, 1)
+
+    def test_overflow_closed_on_release(self):
+        pool = self.pool(max_size=1, max_overflow=1)
+        a, b = pool.acquire(), pool.acquire()
+        self.assertEqual(pool.stats().overflow, 1)
+        pool.release(a)
+        pool.release(b)
+        self.assertTrue(b.closed)
+        self.assertEqual(pool.stats().size, 1)
+
+    def test_recycle(self):
+        pool = self.pool(recycle=0.05)
+        conn = pool.acquire()
+        pool.release(conn)
+        time.sleep(0.1)
+        fresh = pool.acquire()
+        self.assertFalse(fresh is conn)
+        self.assertTrue(conn.closed)
+        s = pool.stats()
+        self.assertEqual((s.recycled, s.size), (1, 1))
+
+    def test_pre_ping(self):
+        pool = self.pool(pre_ping=True)
+        conn = pool.acquire()
+        pool.release(conn)
+        conn.broken = True
+        fresh = pool.acquire()
+        self.assertFalse(fresh is conn)
+        s = pool.stats()
+        self.assertEqual((s.ping_failures, s.size, s.checked_out), (1, 1, 1))
+
+    def test_no_pre_ping_by_default(self):
+        pool = self.pool()
+        conn = pool.acquire()
+        pool.release(conn)
+        conn.broken = True
+        self.assertTrue(pool.acquire() is conn)
+
+    def test_select_does_not_ping(self):
+        pings = []
+        orig = connector.Connection.ping
+        connector.Connection.ping = lambda conn, **kw: pings.append(conn)
+        try:
+            for i in range(3):
+                db.select_one('select 1')
+        finally:
+            connector.Connection.ping = orig
+        self.assertEqual(pings, [])
+        self.assertEqual(db.pool_stats().connects, 1)
+
+    def test_connect_failure_frees_slot(self):
+        calls = []
+        def connect():
+            calls.append(1)
+            if len(calls) == 1:
+                raise connector.Error('refused')
+            return connector.connect(database_path=self.path)
+        pool = db._ConnectionPool(connect, max_size=1, max_overflow=0, timeout=0.1)
+        self.assertRaises(connector.Error, pool.acquire)
+        self.assertEqual(pool.stats().size, 0)
+        pool.acquire()
+
+    def test_engine_connection_returned(self):
+        with db.connection():
+            db.select_int('select 1')
+        s = db.pool_stats()
+        self.assertEqual((s.checkouts, s.checkins, s.checked_out), (1, 1, 0))
+
+if __name__ == '__main__':
+    unittest.main()
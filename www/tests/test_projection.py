@@ -0,0 +1,98 @@
+#coding:utf8
+
+import unittest
+
+from support import DBTestCase, connector
+from transwarp import db
+from transwarp.orm import Model, StringField, TextField
+
+class Article(Model):
+    __table__ = 'articles'
+
+    id = StringField(primary_key=True, ddl='varchar(50)')
+    title = StringField(ddl='varchar(50)')
+    summary = StringField(ddl='varchar(50)')
+    body = TextField(deferred=True)
+
+class CompactArticle(Model):
+    __table__ = 'articles'
+    __compact__ = True
+
+    id = StringField(primary_key=True, ddl='varchar(50)')
+    title = StringField(ddl='varchar(50)')
+    summary = StringField(ddl='varchar(50)')
+    body = TextField(deferred=True)
+
+class ProjectionTest(DBTestCase):
+
+    models = (Article, CompactArticle)
+
+    def setUp(self):
+        super(ProjectionTest, self).setUp()
+        db.update('create table articles (id text primary key, title text, summary text, body text)')
+        db.insert_many('articles', [dict(id=str(i), title='t%d' % i, summary='s%d' % i, body='b%d' % i) for i in range(5)])
+        del connector.LOG[:]
+
+    def test_deferred_field_loaded_once(self):
+        for cls in self.models:
+            inst = cls.get('1')
+            self.assertFalse('body' in inst)
+            n = len(self.statements('select'))
+            self.assertEqual((inst.body, inst.body), ('b1', 'b1'))
+            self.assertEqual(len(self.statements('select')) - n, 1)
+
+    def test_projected_fields_loaded_in_one_query(self):
+        for cls in self.models:
+            inst = cls.get('2', fields=['title'])
+            self.assertEqual(sorted(inst.keys()), ['id', 'title'])
+            n = len(self.statements('select'))
+            self.assertEqual((inst.summary, inst.title), ('s2', 't2'))
+            self.assertEqual(len(self.statements('select')) - n, 1)
+            self.assertFalse('body' in inst)
+
+    def test_save_keeps_unloaded_fields(self):
+        for cls in self.models:
+            inst = cls.get('1')
+            inst.title = 'new'
+            inst.save()
+            inst = cls.get('2', fields=['title'])
+            inst.save()
+            cls.save_many([cls.get('3'), cls.get('4', fields=['summary'])])
+        rows = db.select('select * from articles order by id')
+        self.assertEqual([(d.title, d.summary, d.body) for d in rows[1:]],
+                         [('new', 's1', 'b1'), ('t2', 's2', 'b2'), ('t3', 's3', 'b3'), ('t4', 's4', 'b4')])
+
+    def test_save_loads_unloaded_fields_in_one_query(self):
+        for cls in self.models:
+            items = cls.find_all()
+            n = len(self.statements('select'))
+            cls.save_many(items)
+            self.assertEqual(len(self.statements('select')) - n, 1)
+            self.assertEqual(db.select_one('select body from articles where id=?', '0').body, 'b0')
+
+    def test_undefer_one_query(self):
+        for cls in self.models:
+            items = cls.find_all()
+            n = len(self.statements('select'))
+            cls.undefer(items)
+            self.assertEqual(len(self.statements('select')) - n, 1)
+            self.assertEqual([inst.body for inst in items], ['b%d' % i for i in range(5)])
+            self.assertEqual(len(self.statements('select')) - n, 1)
+
+    def test_contains_does_not_load(self):
+        for cls in self.models:
+            inst = cls.get('3', fields=['title'])
+            n = len(self.statements('select'))
+            self.assertEqual(['summary' in inst, 'body' in inst, 'title' in inst, 'nope' in inst], [False, False, True, False])
+            self.assertEqual(len(self.statements('select')), n)
+
+    def test_update_projected_instance(self):
+        for cls in self.models:
+            inst = cls.get('4', fields=['title'])
+            inst.title = cls.__name__
+            inst.update()
+            self.assertEqual(db.select_one("select title, summary, body from articles where id='4'"),
+                             dict(title=cls.__name__, summary='s4', body='b4'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+#coding:utf8
+
+import unittest
+
+from support import DBTestCase, connector
+from transwarp import db
+from transwarp.orm import Model, StringField, FloatField
+
+class Entry(Model):
+    __table__ = 'entries'
+
+    id = StringField(primary_key=True, ddl='varchar(50)')
+    tag = StringField(ddl='varchar(50)')
+    create_at = FloatField()
+
+class QueryTest(DBTestCase):
+
+    def setUp(self):
+        super(QueryTest, self).setUp()
+        db.update('create table entries (id text primary key, tag text, create_at real)')
+        Entry.insert_many([Entry(id='e%d' % i, tag='odd' if i % 2 else 'even', create_at=float(i)) for i in range(10)])
+        del connector.LOG[:]
+
+    def ids(self, q):
+        return [e.id for e in q]
+
+    def test_lazy_and_chainable(self):
+        q = Entry.query().where('tag=?', 'odd')
+        q2 = q.order_by('-create_at').limit(2)
+        self.assertEqual(connector.LOG, [])
+        self.assertEqual(self.ids(q2), ['e9', 'e7'])
+        self.assertEqual(len(q.order_by('create_at')), 5)
+        #同一个Query只查询一次
+        self.ids(q2)
+        self.assertEqual(len(q2), 2)
+        self.assertEqual(len(self.statements('select')), 2)
+
+    def test_sql(self):
+        q = Entry.query().where('tag=?', 'odd').where('create_at>?', 2).order_by('-create_at', 'id').limit(3).offset(1)
+        self.assertEqual(q.sql(), 'select * from `entries` where (tag=?) and (create_at>?) '
+                                  'order by `create_at` desc,`id` limit 3 offset 1')
+        self.assertRaises(AttributeError, Entry.query().order_by, 'nope')
+
+    def test_slice_becomes_limit_offset(self):
+        q = Entry.query().order_by('create_at')
+        self.assertEqual(self.ids(q[2:5]), ['e2', 'e3', 'e4'])
+        self.assertEqual(self.statements('select')[-1].split(' order by ')[1], '`create_at` limit 3 offset 2')
+        self.assertEqual(q[3].id, 'e3')
+        self.assertEqual(self.statements('select')[-1].split(' order by ')[1], '`create_at` limit 1 offset 3')
+        self.assertRaises(IndexError, lambda: q[20])
+
+    def test_slice_within_limit_and_offset(self):
+        q = Entry.query().order_by('create_at').offset(2).limit(4)
+        self.assertEqual(self.ids(q[1:10]), ['e3', 'e4', 'e5'])
+        self.assertEqual(self.ids(q[1:3]), ['e3', 'e4'])
+        self.assertEqual(self.ids(q[5:]), [])
+
+    def test_offset_without_limit(self):
+        self.assertEqual(self.ids(Entry.query().order_by('create_at').offset(8)), ['e8', 'e9'])
+        self.assertEqual(self.ids(Entry.query().order_by('create_at')[7:]), ['e7', 'e8', 'e9'])
+
+    def test_negative_index_and_step(self):
+        q = Entry.query().order_by('create_at')
+        self.assertEqual(q[-1].id, 'e9')
+        self.assertEqual(self.ids(q[::3]), ['e0', 'e3', 'e6', 'e9'])
+
+    def test_first_and_count(self):
+        q = Entry.query().where('tag=?', 'even').order_by('-create_at')
+        self.assertEqual(q.first().id, 'e8')
+        self.assertTrue(Entry.query().where('tag=?', 'none').first() is None)
+        self.assertEqual(q.limit(2).count(), 5)
+        self.assertEqual(Entry.query().count(), 10)
+
+    def test_only(self):
+        e = Entry.query().only('tag').order_by('create_at').first()
+        self.assertEqual(sorted(e.keys()), ['create_at', 'id', 'tag'])
+
+class SeekTest(DBTestCase):
+
+    def setUp(self):
+        super(SeekTest, self).setUp()
+        db.update('create table entries (id text primary key, tag text, create_at real)')
+        #每两行的create_at相同，翻页时靠主键区分
+        Entry.insert_many([Entry(id='e%d' % i, tag='t', create_at=float(i // 2)) for i in range(7)])
+
+    def ids(self, page):
+        return [e.id for e in page.rows]
+
+    def test_forward(self):
+        page = Entry.seek(limit=3)
+        self.assertEqual(self.ids(page), ['e6', 'e5', 'e4'])
+        self.assertTrue(page.prev is None)
+        page = Entry.seek(page.next, limit=3)
+        self.assertEqual(self.ids(page), ['e3', 'e2', 'e1'])
+        page = Entry.seek(page.next, limit=3)
+        self.assertEqual(self.ids(page), ['e0'])
+        self.assertTrue(page.next is None)
+        self.assertFalse(page.prev is None)
+
+    def test_backward(self):
+        first = Entry.seek(limit=3)
+        second = Entry.seek(first.next, limit=3)
+        back = Entry.seek(second.prev, limit=3, backward=True)
+        self.assertEqual(self.ids(back), ['e6', 'e5', 'e4'])
+        self.assertTrue(back.prev is None)
+        self.assertEqual(self.ids(Entry.seek(back.next, limit=3)), ['e3', 'e2', 'e1'])
+
+    def test_ascending_with_where(self):
+        q = Entry.query().where('create_at>=?', 1)
+        page = q.seek(limit=2, desc=False)
+        self.assertEqual(self.ids(page), ['e2', 'e3'])
+        page = q.seek(page.next, limit=2, desc=False)
+        self.assertEqual(self.ids(page), ['e4', 'e5'])
+        self.assertEqual(self.ids(q.seek(page.prev, limit=2, desc=False, backward=True)), ['e2', 'e3'])
+
+    def test_bad_cursor(self):
+        self.assertRaises(ValueError, Entry.seek, 'not-a-cursor')
+        self.assertRaises(ValueError, Entry.query().order_by('id').seek)
+
+if __name__ == '__main__':
+    unittest.main()
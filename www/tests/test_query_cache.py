@@ -0,0 +1,183 @@
+#coding:utf8
+
+import pickle
+import sqlite3
+import threading
+import unittest
+
+from support import DBTestCase, connector
+from transwarp import db, orm
+from transwarp.orm import Model, StringField, FloatField
+
+class CachedItem(Model):
+    __table__ = 'cached_items'
+
+    id = StringField(primary_key=True, ddl='varchar(50)')
+    name = StringField(ddl='varchar(50)')
+    rank = FloatField()
+
+class CachedUser(Model):
+    __table__ = 'cached_users'
+    __cache_size__ = 10
+
+    id = StringField(primary_key=True, ddl='varchar(50)')
+    name = StringField(ddl='varchar(50)')
+
+class _PickleBackend(object):
+    '''
+    像memcached一样只保存pickle之后的数据
+    '''
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        v = self.data.get(repr(key))
+        return None if v is None else pickle.loads(v)
+
+    def put(self, key, value):
+        self.data[repr(key)] = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def clear(self):
+        self.data.clear()
+
+class QueryCacheTest(DBTestCase):
+
+    def setUp(self):
+        super(QueryCacheTest, self).setUp()
+        db.update('create table cached_items (id text primary key, name text, rank real)')
+        CachedItem.insert_many([CachedItem(id=str(i), name='n%d' % i, rank=float(i)) for i in range(3)])
+        orm.enable_query_cache(size=100, ttl=60)
+        del connector.LOG[:]
+
+    def names(self):
+        return [inst.name for inst in CachedItem.find_by('where rank>=? order by rank', 0)]
+
+    def test_hit(self):
+        self.assertEqual(self.names(), ['n0', 'n1', 'n2'])
+        self.assertEqual(self.names(), ['n0', 'n1', 'n2'])
+        self.assertEqual(len(self.statements('select')), 1)
+        self.assertEqual((orm.query_cache.hits, orm.query_cache.misses), (1, 1))
+
+    def test_count_and_empty_result_cached(self):
+        CachedItem.count_by('where rank>?', 0)
+        CachedItem.count_by('where rank>?', 0)
+        CachedItem.find_first('where id=?', 'missing')
+        self.assertTrue(CachedItem.find_first('where id=?', 'missing') is None)
+        self.assertEqual(len(self.statements('select')), 2)
+
+    def test_cached_instances_are_copies(self):
+        self.names()
+        CachedItem.find_by('where rank>=? order by rank', 0)[0].name = 'mutated'
+        self.assertEqual(self.names()[0], 'n0')
+
+    def test_orm_write_invalidates(self):
+        self.names()
+        inst = CachedItem.get('1')
+        inst.name = 'changed'
+        inst.update()
+        self.assertEqual(self.names(), ['n0', 'changed', 'n2'])
+        CachedItem(id='3', name='n3', rank=3.0).insert()
+        self.assertEqual(len(self.names()), 4)
+        CachedItem.delete_where('where id=?', '0')
+        self.assertEqual(len(self.names()), 3)
+
+    def test_raw_write_invalidates(self):
+        self.names()
+        db.update("update cached_items set name='raw' where id='2'")
+        self.assertEqual(self.names()[2], 'raw')
+        db.update_many('delete from `cached_items` where id=?', [('0',)])
+        self.assertEqual(len(self.names()), 2)
+
+    def test_transaction_bypasses_cache(self):
+        self.names()
+        with db.transaction():
+            CachedItem(id='3', name='n3', rank=3.0).insert()
+            self.assertEqual(len(self.names()), 4)
+        self.assertEqual(len(self.names()), 4)
+
+    def test_other_table_write_keeps_entry(self):
+        db.update('create table other_items (id text)')
+        self.names()
+        db.update("insert into other_items values ('x')")
+        self.names()
+        self.assertEqual(orm.query_cache.hits, 1)
+
+    def test_read_between_write_and_commit(self):
+        self.names()
+        orig = connector.Connection.commit
+        def commit(conn):
+            #写已经执行但还没提交时，别的线程读到旧数据并放进缓存
+            t = threading.Thread(target=self.names)
+            t.start()
+            t.join()
+            orig(conn)
+        connector.Connection.commit = commit
+        try:
+            db.update("update cached_items set name='new' where id='0'")
+        finally:
+            connector.Connection.commit = orig
+        self.assertEqual(db.select_one("select name from cached_items where id='0'").name, 'new')
+        self.assertEqual(self.names()[0], 'new')
+
+    def test_pickling_backend(self):
+        orm.enable_query_cache(backend=_PickleBackend())
+        self.assertEqual(self.names(), ['n0', 'n1', 'n2'])
+        self.assertEqual(self.names(), ['n0', 'n1', 'n2'])
+        self.assertEqual(CachedItem.find_first('where id=?', '1').name, 'n1')
+        self.assertEqual(CachedItem.find_first('where id=?', '1').name, 'n1')
+        self.assertEqual(len(self.statements('select')), 2)
+
+    def test_row_pickle(self):
+        r = db.select_one('select * from cached_items where id=?', '1', compact=True)
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            r2 = pickle.loads(pickle.dumps(r, protocol))
+            self.assertEqual((r2.name, r2['rank'], r2), (r.name, r['rank'], r))
+            self.assertTrue(type(r2) is type(r))
+
+class ReplicaLagTest(DBTestCase):
+    '''
+    副本是单独的sqlite文件，永远收不到主库的写入，相当于延迟无限大
+    '''
+
+    def setUp(self):
+        super(ReplicaLagTest, self).setUp()
+        replica = self.db_path('replica')
+        for path in (self.path, replica):
+            conn = sqlite3.connect(path)
+            conn.execute('create table cached_users (id text primary key, name text)')
+            conn.execute("insert into cached_users values ('1', 'old')")
+            conn.commit()
+            conn.close()
+        db.set_replicas([db._Engine(lambda: connector.connect(database_path=replica))])
+        orm.enable_query_cache()
+        CachedUser.__cache__.clear()
+
+    def test_uncached_reads_use_replica(self):
+        orm.disable_query_cache()
+        db.update("update cached_users set name='new'")
+        self.assertEqual(CachedUser.find_first('where id=?', '1').name, 'old')
+
+    def test_query_cache_filled_from_primary(self):
+        self.assertEqual(CachedUser.find_first('where id=?', '1').name, 'old')
+        CachedUser.update_where({'name': 'new'}, 'where id=?', '1')
+        self.assertEqual(CachedUser.find_first('where id=?', '1').name, 'new')
+        self.assertEqual(CachedUser.count_by('where name=?', 'new'), 1)
+
+    def test_get_cache_filled_from_primary(self):
+        self.assertEqual(CachedUser.get('1').name, 'old')
+        inst = CachedUser.get('1')
+        inst.name = 'new'
+        inst.update()
+        self.assertEqual(CachedUser.get('1').name, 'new')
+        self.assertEqual(CachedUser.get('1').name, 'new')
+        self.assertEqual(CachedUser.get_many(['1'])[0].name, 'new')
+
+    def test_get_many_cache_filled_from_primary(self):
+        CachedUser(id='2', name='new').insert()
+        self.assertEqual([u.name for u in CachedUser.get_many(['1', '2'])], ['old', 'new'])
+        hits = CachedUser.cache_stats().hits
+        self.assertEqual(CachedUser.get('2').name, 'new')
+        self.assertEqual(CachedUser.cache_stats().hits, hits + 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+#coding:utf8
+
+import os
+import time
+import sqlite3
+import unittest
+
+from support import DBTestCase, connector, reset
+from transwarp import db
+
+class ReplicaTest(DBTestCase):
+    '''
+    主库和每个副本是不同的sqlite文件，表places中的一行记录了数据来自哪个库
+    '''
+
+    def setUp(self):
+        super(ReplicaTest, self).setUp()
+        self.seed(self.path, 'primary')
+
+    def seed(self, path, name):
+        conn = sqlite3.connect(path)
+        conn.execute('create table places (name text)')
+        conn.execute('insert into places values (?)', (name,))
+        conn.commit()
+        conn.close()
+
+    def replica(self, name, seed=True, **kw):
+        path = self.db_path(name)
+        if seed:
+            self.seed(path, name)
+        return db._Engine(lambda: connector.connect(database_path=path), **kw)
+
+    def where(self):
+        return db.select_one('select name from places').name
+
+    def test_create_engine_replicas(self):
+        reset()
+        self.seed(self.db_path('r'), 'r')
+        db.create_engine('u', 'p', 'test', database_path=self.path, replicas=[dict(database_path=self.db_path('r'))])
+        self.assertEqual(self.where(), 'r')
+        self.assertEqual(len(db.replica_stats()), 1)
+
+    def test_reads_go_to_replica(self):
+        db.set_replicas([self.replica('r1')])
+        self.assertEqual(self.where(), 'r1')
+        self.assertEqual(db.select_int('select count(*) from places'), 1)
+        self.assertEqual([r.name for r in db.iter_select('select name from places')], ['r1'])
+
+    def test_transaction_reads_primary(self):
+        db.set_replicas([self.replica('r1')])
+        with db.transaction():
+            self.assertEqual(self.where(), 'primary')
+
+    def test_round_robin(self):
+        db.set_replicas([self.replica('r1'), self.replica('r2')])
+        self.assertEqual(sorted([self.where() for i in range(4)]), ['r1', 'r1', 'r2', 'r2'])
+
+    def test_least_busy(self):
+        r1, r2 = self.replica('r1'), self.replica('r2')
+        db.set_replicas([r1, r2], strategy='least_busy')
+        conn = r1.connect()
+        self.assertEqual([self.where() for i in range(3)], ['r2'] * 3)
+        r1.release(conn)
+
+    def test_pool_timeout_skips_replica(self):
+        r1, r2 = self.replica('r1', max_size=1, max_overflow=0, timeout=0), self.replica('r2')
+        db.set_replicas([r1, r2])
+        conn = r1.connect()
+        self.assertEqual([self.where() for i in range(2)], ['r2', 'r2'])
+        #连接池满不代表副本不可用
+        self.assertFalse(db.replica_stats()[0].down)
+        r1.release(conn)
+
+    def test_saturated_replica_does_not_block(self):
+        r1 = self.replica('r1', max_size=1, max_overflow=0, timeout=5)
+        db.set_replicas([r1, self.replica('r2')])
+        conn = r1.connect()
+        start = time.time()
+        self.assertEqual([self.where() for i in range(4)], ['r2'] * 4)
+        self.assertTrue(time.time() - start < 1)
+        r1.release(conn)
+
+    def test_all_replicas_saturated_falls_back_to_primary(self):
+        r1 = self.replica('r1', max_size=1, max_overflow=0, timeout=5)
+        db.set_replicas([r1])
+        conn = r1.connect()
+        self.assertEqual(self.where(), 'primary')
+        r1.release(conn)
+        self.assertEqual(self.where(), 'r1')
+
+    def test_mark_down_and_retry(self):
+        path = os.path.join(self.dir, 'later', 'r1.db')
+        bad = db._Engine(lambda: connector.connect(database_path=path))
+        db.set_replicas([bad, self.replica('r2')], retry=0.1)
+        self.assertEqual([self.where() for i in range(3)], ['r2'] * 3)
+        self.assertEqual([d.down for d in db.replica_stats()], [True, False])
+        #副本恢复后，过了retry秒重新尝试
+        os.mkdir(os.path.dirname(path))
+        self.seed(path, 'r1')
+        self.assertEqual(self.where(), 'r2')
+        time.sleep(0.15)
+        self.assertEqual(sorted([self.where() for i in range(2)]), ['r1', 'r2'])
+        self.assertEqual([d.down for d in db.replica_stats()], [False, False])
+
+    def test_fallback_to_primary(self):
+        bad = db._Engine(lambda: connector.connect(database_path=os.path.join(self.dir, 'missing', 'r.db')))
+        db.set_replicas([bad])
+        self.assertEqual(self.where(), 'primary')
+        self.assertEqual(self.where(), 'primary')
+        self.assertEqual(db.replica_stats()[0].connects, 0)
+
+    def test_read_your_writes_in_connection(self):
+        db.set_replicas([self.replica('r1')])
+        with db.connection():
+            self.assertEqual(self.where(), 'r1')
+            db.update("update places set name='written'")
+            self.assertEqual(self.where(), 'written')
+        #离开connection()后不再固定到主库
+        self.assertEqual(self.where(), 'r1')
+
+    def test_workers_read_primary_after_write(self):
+        db.set_replicas([self.replica('r1')])
+        with db.connection():
+            self.assertEqual(db.gather('select name from places')[0][0].name, 'r1')
+            db.update("update places set name='written'")
+            self.assertEqual(db.gather('select name from places')[0][0].name, 'written')
+            self.assertEqual(db.submit(self.where).get(), 'written')
+        with db.read_primary():
+            self.assertEqual(db.aselect_one('select name from places').get().name, 'written')
+        self.assertEqual(db.submit(self.where).get(), 'r1')
+
+    def test_connection_middleware(self):
+        db.set_replicas([self.replica('r1')])
+        seen = []
+        def app(environ, start_response):
+            db.update("update places set name='written'")
+            start_response('200 OK', [])
+            yield 'a'
+            seen.append(self.where())
+            yield 'b'
+        body = db.connection_middleware(app)({}, lambda status, headers: None)
+        self.assertEqual(list(body), ['a', 'b'])
+        self.assertEqual(seen, ['written'])
+        self.assertEqual(db.pool_stats().checked_out, 0)
+        self.assertEqual([d.checked_out for d in db.replica_stats()], [0])
+
+    def test_connection_middleware_closes_body(self):
+        closed = []
+        class Body(list):
+            def close(self):
+                closed.append(True)
+        def app(environ, start_response):
+            start_response('200 OK', [])
+            return Body(['x'])
+        self.assertEqual(list(db.connection_middleware(app)({}, lambda status, headers: None)), ['x'])
+        self.assertEqual(closed, [True])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+#coding:utf8
+
+import json
+import unittest
+
+from support import DBTestCase
+from transwarp import db
+
+class SelectTest(DBTestCase):
+
+    def setUp(self):
+        super(SelectTest, self).setUp()
+        db.update('create table people (id integer primary key, name text)')
+        db.insert_many('people', [dict(id=i, name=u'p%d' % i) for i in range(3)])
+
+    def test_default_rows_are_dicts(self):
+        r = db.select_one('select * from people where id=?', 1)
+        self.assertTrue(isinstance(r, dict))
+        self.assertEqual(json.loads(json.dumps(r)), {'id': 1, 'name': 'p1'})
+        r.name = u'changed'
+        r['extra'] = 1
+        self.assertEqual((r['name'], r.extra), (u'changed', 1))
+        rows = db.select('select * from people order by id')
+        self.assertTrue(all([isinstance(x, db.Dict) for x in rows]))
+        self.assertTrue(isinstance(db.iter_select('select * from people').next(), db.Dict))
+
+    def test_compact_rows(self):
+        rows = db.select('select * from people order by id', compact=True)
+        r = rows[1]
+        self.assertTrue(isinstance(r, db.Row))
+        self.assertTrue(type(rows[0]) is type(r))
+        self.assertEqual((r[0], r['name'], r.name), (1, u'p1', u'p1'))
+        self.assertEqual(r, {'id': 1, 'name': u'p1'})
+        self.assertRaises(AttributeError, setattr, r, 'name', 'x')
+        self.assertEqual(json.loads(json.dumps(r.as_dict())), {'id': 1, 'name': 'p1'})
+        self.assertTrue(isinstance(db.select_one('select * from people', compact=True), db.Row))
+        self.assertTrue(isinstance(db.iter_select('select * from people', compact=True).next(), db.Row))
+
+    def test_unknown_keyword(self):
+        self.assertRaises(TypeError, db.select, 'select * from people', compac=True)
+
+    def test_unicode_sql(self):
+        db.update(u"insert into people values (9, '中文')")
+        self.assertEqual(db.select_one(u"select id from people where name='中文'").id, 9)
+        self.assertEqual([r.name for r in db.iter_select(u"select name from people where name=? or name='中文'", u'p0')], [u'p0', u'中文'])
+        self.assertEqual(db.compile_sql(u'select ?'), u'select %s')
+        self.assertTrue(isinstance(db.compile_sql(u'select ?'), unicode))
+        self.assertTrue(isinstance(db.compile_sql('select ?'), str))
+
+    def test_unicode_sql_traced(self):
+        db.enable_tracing()
+        self.addCleanup(db.set_slow_query_threshold, db.metrics.slow_threshold)
+        db.set_slow_query_threshold(0)
+        db.update(u"update people set name='中文' where id=?", 1)
+        self.assertEqual(type(db.trace_dump()[-1].sql), unicode)
+        self.assertTrue(u'中文' in db.format_trace())
+        self.assertEqual(db.metrics_snapshot().slow_queries[-1].sql, u"update people set name='中文' where id=%s")
+
+    def test_select_int(self):
+        self.assertEqual(db.select_int('select count(*) from people'), 3)
+        self.assertRaises(db.MultiColumnsError, db.select_int, 'select id, name from people')
+
+if __name__ == '__main__':
+    unittest.main()
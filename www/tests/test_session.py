@@ -0,0 +1,149 @@
+#coding:utf8
+
+import unittest
+
+from support import DBTestCase, connector
+from transwarp import db, orm
+from transwarp.orm import Model, StringField
+
+class SessionItem(Model):
+    __table__ = 'session_items'
+
+    id = StringField(primary_key=True, ddl='varchar(50)')
+    name = StringField(ddl='varchar(50)')
+    note = StringField(ddl='varchar(50)')
+
+class SessionCounted(Model):
+    __table__ = 'session_counted'
+    __counters__ = ('*', 'kind')
+
+    id = StringField(primary_key=True, ddl='varchar(50)')
+    kind = StringField(ddl='varchar(50)')
+
+class SessionTest(DBTestCase):
+
+    def setUp(self):
+        super(SessionTest, self).setUp()
+        db.update('create table session_items (id text primary key, name text, note text)')
+        SessionItem.insert_many([SessionItem(id=str(i), name='n%d' % i, note='') for i in range(3)])
+        del connector.LOG[:]
+
+    def rows(self):
+        return [(r.id, r.name, r.note) for r in db.select('select * from session_items order by id')]
+
+    def test_writes_deferred_until_commit(self):
+        with orm.session() as s:
+            SessionItem(id='9', name='new', note='').insert()
+            self.assertEqual(len(s), 1)
+            self.assertEqual(db.select_int('select count(*) from session_items'), 3)
+        self.assertEqual(db.select_int('select count(*) from session_items'), 4)
+
+    def test_updates_merged(self):
+        items = SessionItem.find_all()
+        del connector.LOG[:]
+        with orm.session() as s:
+            for inst in items:
+                inst.name = 'x'
+                inst.update()
+                inst.note = 'y'
+                inst.update()
+            self.assertEqual(len(s), 3)
+        self.assertEqual(self.statements('update'), ['update `session_items` set `name`=%s,`note`=%s where `id`=%s'])
+        self.assertEqual(self.rows(), [('0', 'x', 'y'), ('1', 'x', 'y'), ('2', 'x', 'y')])
+
+    def test_insert_then_update_is_one_insert(self):
+        with orm.session():
+            inst = SessionItem(id='9', name='a', note='')
+            inst.insert()
+            inst.name = 'b'
+            inst.update()
+        self.assertEqual(len(self.statements('insert')), 1)
+        self.assertEqual(self.statements('update'), [])
+        self.assertEqual(self.rows()[-1], ('9', 'b', ''))
+
+    def test_insert_then_delete_cancels(self):
+        with orm.session() as s:
+            inst = SessionItem(id='9', name='a', note='')
+            inst.insert()
+            inst.delete()
+            self.assertEqual(len(s), 0)
+        self.assertEqual(connector.LOG, [])
+
+    def test_update_then_delete(self):
+        inst = SessionItem.get('1')
+        del connector.LOG[:]
+        with orm.session():
+            inst.name = 'gone'
+            inst.update()
+            inst.delete()
+        self.assertEqual(self.statements('update'), [])
+        self.assertEqual(len(self.statements('delete')), 1)
+        self.assertEqual([r[0] for r in self.rows()], ['0', '2'])
+
+    def test_delete_then_insert_replaces(self):
+        inst = SessionItem.get('1')
+        with orm.session():
+            inst.delete()
+            SessionItem(id='1', name='again', note='').insert()
+        self.assertEqual(self.rows()[1], ('1', 'again', ''))
+
+    def test_duplicate_insert_raises(self):
+        def insert_twice():
+            with orm.session():
+                SessionItem(id='9', name='a', note='').insert()
+                SessionItem(id='9', name='b', note='').insert()
+        self.assertRaises(db.DBError, insert_twice)
+        self.assertEqual(len(self.rows()), 3)
+
+    def test_insert_after_update_raises(self):
+        inst = SessionItem.get('1')
+        def update_then_insert():
+            with orm.session():
+                inst.name = 'x'
+                inst.update()
+                SessionItem(id='1', name='y', note='').insert()
+        self.assertRaises(db.DBError, update_then_insert)
+        self.assertEqual(self.rows()[1], ('1', 'n1', ''))
+        self.assertTrue(orm._session_ctx.uow is None)
+
+    def test_counters_skip_missing_deletes(self):
+        db.update(orm.COUNTERS_DDL)
+        db.update('create table session_counted (id text primary key, kind text)')
+        SessionCounted.insert_many([SessionCounted(id=str(i), kind='a') for i in range(3)])
+        gone = SessionCounted.get('0')
+        db.update("delete from session_counted where id='0'")
+        SessionCounted.rebuild_counters()
+        with orm.session():
+            gone.delete()
+            SessionCounted.get('1').delete()
+            SessionCounted(id='9', kind='b').insert()
+        self.assertEqual((SessionCounted.count_all(), SessionCounted.count_of('kind', 'a'), SessionCounted.count_of('kind', 'b')), (2, 1, 1))
+
+    def test_set_based_statements_see_queued_writes(self):
+        with orm.session() as s:
+            SessionItem(id='9', name='a', note='tmp').insert()
+            SessionItem(id='8', name='a', note='tmp').insert()
+            self.assertEqual(SessionItem.update_where({'name': 'b'}, 'where note=?', 'tmp'), 2)
+            self.assertEqual(len(s), 0)
+            SessionItem(id='7', name='a', note='tmp').insert()
+            self.assertEqual(SessionItem.delete_many(['9', '7']), 2)
+            inst = SessionItem.get('0')
+            inst.note = 'tmp'
+            inst.update()
+            self.assertEqual(SessionItem.delete_where('where note=?', 'tmp'), 2)
+        self.assertEqual([r[0] for r in self.rows()], ['1', '2'])
+
+    def test_rollback_discards(self):
+        inst = SessionItem.get('0')
+        try:
+            with orm.session():
+                inst.name = 'rolled'
+                inst.update()
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(self.rows()[0], ('0', 'n0', ''))
+        self.assertTrue(orm._session_ctx.uow is None)
+
+if __name__ == '__main__':
+    unittest.main()
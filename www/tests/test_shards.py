@@ -0,0 +1,126 @@
+#coding:utf8
+
+import unittest
+
+from support import DBTestCase
+from transwarp import db, orm
+from transwarp.orm import Model, StringField, IntegerField
+
+class ShardedNote(Model):
+    __table__ = 'notes'
+    __shard_key__ = 'user_id'
+
+    id = StringField(primary_key=True, ddl='varchar(50)')
+    user_id = StringField(ddl='varchar(50)')
+    n = IntegerField()
+
+class ShardTest(DBTestCase):
+
+    def setUp(self):
+        super(ShardTest, self).setUp()
+        for name in ('s0', 's1'):
+            db.create_engine('u', 'p', 'test', database_path=self.db_path(name), name=name)
+            with db.using(name):
+                db.update('create table notes (id text primary key, user_id text, n integer)')
+        db.set_shard_router(['s0', 's1'])
+        db.update('create table logs (id text primary key)')
+        #每个分片上各挑两个用户
+        self.users = {'s0': [], 's1': []}
+        i = 0
+        while len(self.users['s0']) < 2 or len(self.users['s1']) < 2:
+            uid = 'u%d' % i
+            self.users[db.shard_router.shard_for(uid)].append(uid)
+            i += 1
+
+    def rows(self, name):
+        with db.using(name):
+            return [(d.id, d.user_id, d.n) for d in db.select('select * from notes order by id')]
+
+    def note(self, id, user_id, n=0):
+        return ShardedNote(id=id, user_id=user_id, n=n)
+
+    def test_insert_routed_by_shard_key(self):
+        a, b = self.users['s0'][0], self.users['s1'][0]
+        self.note('1', a, 1).insert()
+        self.note('2', b, 2).insert()
+        self.assertEqual(self.rows('s0'), [('1', a, 1)])
+        self.assertEqual(self.rows('s1'), [('2', b, 2)])
+
+    def test_get_and_find(self):
+        a, b = self.users['s0'][0], self.users['s1'][0]
+        self.note('1', a, 1).insert()
+        self.note('2', b, 2).insert()
+        self.assertEqual(ShardedNote.get('2', shard=b).n, 2)
+        self.assertEqual(ShardedNote.get('2', shard=a), None)
+        self.assertEqual(ShardedNote.get('2').n, 2)
+        self.assertEqual(sorted(x.id for x in ShardedNote.find_all()), ['1', '2'])
+        self.assertEqual([x.id for x in ShardedNote.find_by('where n>?', 0, shard=a)], ['1'])
+
+    def test_update_routed_by_shard_key(self):
+        a, b = self.users['s0'][0], self.users['s1'][0]
+        self.note('1', a, 1).insert()
+        self.note('2', b, 2).insert()
+        inst = ShardedNote.get('2', shard=b)
+        inst.n = 20
+        inst.update()
+        self.assertEqual(self.rows('s1'), [('2', b, 20)])
+        self.assertEqual(self.rows('s0'), [('1', a, 1)])
+
+    def test_merged_query_order(self):
+        users = self.users['s0'] + self.users['s1']
+        for i in range(8):
+            self.note(str(i), users[i % 4], (i * 5) % 8).insert()
+        q = ShardedNote.query().order_by('-n')
+        self.assertEqual([x.n for x in q], [7, 6, 5, 4, 3, 2, 1, 0])
+        self.assertEqual([x.n for x in q.limit(3)], [7, 6, 5])
+        self.assertEqual([x.n for x in q.offset(2).limit(3)], [5, 4, 3])
+        self.assertEqual([x.n for x in ShardedNote.query().order_by('n')[1:4]], [1, 2, 3])
+
+    def test_writes_roll_back_with_outer_transaction(self):
+        a, b = self.users['s0'][0], self.users['s1'][0]
+        self.note('1', a, 1).insert()
+        try:
+            with db.transaction():
+                db.insert('logs', id='x')
+                self.note('2', b, 2).insert()
+                ShardedNote.update_where({'n': 10}, 'where 1=1')
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(db.select_int('select count(*) from logs'), 0)
+        self.assertEqual(self.rows('s0'), [('1', a, 1)])
+        self.assertEqual(self.rows('s1'), [])
+
+    def test_writes_commit_with_outer_transaction(self):
+        a, b = self.users['s0'][0], self.users['s1'][0]
+        with db.transaction():
+            db.insert('logs', id='x')
+            self.note('1', a, 1).insert()
+            self.note('2', b, 2).insert()
+            with db.using('s0'):
+                #加入了外层事务，读到的是同一个连接上还没有提交的数据
+                self.assertEqual(db.select_int('select count(*) from notes'), 1)
+        self.assertEqual(db.select_int('select count(*) from logs'), 1)
+        self.assertEqual(self.rows('s0'), [('1', a, 1)])
+        self.assertEqual(self.rows('s1'), [('2', b, 2)])
+
+    def test_session_flush_on_shards(self):
+        a, b = self.users['s0'][0], self.users['s1'][0]
+        with orm.session():
+            self.note('1', a, 1).insert()
+            self.note('2', b, 2).insert()
+        self.assertEqual(self.rows('s0'), [('1', a, 1)])
+        self.assertEqual(self.rows('s1'), [('2', b, 2)])
+        def fail():
+            raise ValueError()
+        try:
+            with orm.session():
+                self.note('3', a, 3).insert()
+                #在session的flush之后、提交之前出错
+                db.before_commit(fail)
+        except ValueError:
+            pass
+        self.assertEqual(self.rows('s0'), [('1', a, 1)])
+
+if __name__ == '__main__':
+    unittest.main()
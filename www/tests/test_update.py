@@ -0,0 +1,97 @@
+#coding:utf8
+
+import unittest
+
+from support import DBTestCase, connector
+from transwarp import db
+from transwarp.orm import Model, StringField, FloatField
+
+class Profile(Model):
+    __table__ = 'profiles'
+
+    id = StringField(primary_key=True, ddl='varchar(50)')
+    name = StringField(ddl='varchar(50)')
+    email = StringField(updatable=False, ddl='varchar(50)')
+    score = FloatField()
+
+class CompactProfile(Model):
+    __table__ = 'profiles'
+    __compact__ = True
+
+    id = StringField(primary_key=True, ddl='varchar(50)')
+    name = StringField(ddl='varchar(50)')
+    email = StringField(updatable=False, ddl='varchar(50)')
+    score = FloatField()
+
+class UpdateTest(DBTestCase):
+
+    models = (Profile, CompactProfile)
+
+    def setUp(self):
+        super(UpdateTest, self).setUp()
+        db.update('create table profiles (id text primary key, name text, email text, score real)')
+        db.insert('profiles', id='1', name='a', email='a@x', score=1.0)
+        del connector.LOG[:]
+
+    def row(self):
+        return db.select_one("select name, email, score from profiles where id='1'")
+
+    def test_only_changed_columns_written(self):
+        for cls in self.models:
+            inst = cls.get('1')
+            inst.score = 2.0
+            self.assertEqual(inst.dirty_fields(), ['score'])
+            del connector.LOG[:]
+            inst.update()
+            self.assertEqual(connector.LOG, [('update `profiles` set `score`=%s where `id`=%s', (2.0, '1'))])
+            self.assertEqual(inst.dirty_fields(), [])
+            inst.score = 1.0
+            inst.update()
+
+    def test_nothing_changed_sends_nothing(self):
+        for cls in self.models:
+            inst = cls.get('1')
+            del connector.LOG[:]
+            inst.update()
+            inst.name = 'a'
+            inst.update()
+            self.assertEqual(connector.LOG, [])
+
+    def test_changed_back_is_clean(self):
+        for cls in self.models:
+            inst = cls.get('1')
+            inst.name = 'b'
+            inst.name = 'a'
+            self.assertEqual(inst.dirty_fields(), [])
+            del connector.LOG[:]
+            inst.update()
+            self.assertEqual(connector.LOG, [])
+
+    def test_not_updatable_field_ignored(self):
+        for cls in self.models:
+            inst = cls.get('1')
+            inst.email = 'changed@x'
+            del connector.LOG[:]
+            inst.update()
+            self.assertEqual(connector.LOG, [])
+            self.assertEqual(self.row().email, 'a@x')
+
+    def test_columns_subset_reuses_statement(self):
+        a, b = Profile.get('1'), Profile.get('1')
+        a.name = 'x'
+        b.name = 'y'
+        a.update()
+        b.update()
+        self.assertTrue(Profile._partial_update_sql((('name', Profile.__mappings__['name']),)) is
+                        Profile._partial_update_sql((('name', Profile.__mappings__['name']),)))
+        self.assertEqual(self.row().name, 'y')
+
+    def test_new_instance_updates_all_fields(self):
+        inst = Profile(id='1', name='n', email='ignored', score=5.0)
+        del connector.LOG[:]
+        inst.update()
+        self.assertEqual(connector.LOG, [('update `profiles` set `name`=%s,`score`=%s where `id`=%s', ('n', 5.0, '1'))])
+        self.assertEqual(self.row(), dict(name='n', email='a@x', score=5.0))
+
+if __name__ == '__main__':
+    unittest.main()
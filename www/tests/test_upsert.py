@@ -0,0 +1,77 @@
+#coding:utf8
+
+import unittest
+
+from support import DBTestCase, connector
+from transwarp import db, orm
+from transwarp.orm import Model, StringField, IntegerField
+
+class Setting(Model):
+    __table__ = 'settings'
+    __counters__ = ('*', 'scope')
+
+    id = StringField(primary_key=True, ddl='varchar(50)')
+    scope = StringField(ddl='varchar(50)')
+    value = StringField(ddl='varchar(50)')
+    create_by = StringField(updatable=False, ddl='varchar(50)')
+
+class UpsertTest(DBTestCase):
+
+    def setUp(self):
+        super(UpsertTest, self).setUp()
+        db.update(orm.COUNTERS_DDL)
+        db.update('create table settings (id text primary key, scope text, value text, create_by text)')
+        db.insert('settings', id='1', scope='a', value='old', create_by='x')
+        Setting.rebuild_counters()
+        del connector.LOG[:]
+
+    def rows(self):
+        return [(r.id, r.scope, r.value, r.create_by) for r in db.select('select * from settings order by id')]
+
+    def counts(self):
+        return (Setting.count_all(), Setting.count_of('scope', 'a'), Setting.count_of('scope', 'b'))
+
+    def test_db_upsert(self):
+        db.upsert('settings', ['id'], id='1', scope='a', value='new', create_by='y')
+        db.upsert('settings', ['id'], id='2', scope='b', value='v', create_by='y')
+        self.assertEqual(self.rows(), [('1', 'a', 'new', 'y'), ('2', 'b', 'v', 'y')])
+        self.assertEqual(len(self.statements('insert')), 2)
+
+    def test_db_upsert_keeps_keys(self):
+        db.upsert('settings', ['id', 'create_by'], id='1', scope='a', value='new', create_by='y')
+        self.assertEqual(self.rows(), [('1', 'a', 'new', 'x')])
+
+    def test_db_upsert_many(self):
+        rows = [dict(id=str(i), scope='a', value='v%d' % i, create_by='y') for i in range(1, 4)]
+        db.upsert_many('settings', ['id'], rows, max_rows=2)
+        self.assertEqual(len(self.statements('insert')), 2)
+        self.assertEqual([r[2] for r in self.rows()], ['v1', 'v2', 'v3'])
+
+    def test_save(self):
+        Setting(id='1', scope='a', value='new', create_by='ignored').save()
+        Setting(id='2', scope='b', value='v', create_by='y').save()
+        self.assertEqual(self.rows(), [('1', 'a', 'new', 'x'), ('2', 'b', 'v', 'y')])
+        #只有新插入的行计数
+        self.assertEqual(self.counts(), (2, 1, 1))
+
+    def test_save_many(self):
+        Setting.save_many([Setting(id=str(i), scope='b', value='v', create_by='y') for i in range(1, 4)])
+        self.assertEqual(self.rows(), [('1', 'b', 'v', 'x'), ('2', 'b', 'v', 'y'), ('3', 'b', 'v', 'y')])
+        self.assertEqual(Setting.count_all(), 3)
+
+    def test_save_after_delete_in_session(self):
+        with orm.session():
+            Setting.get('1').delete()
+            Setting(id='1', scope='b', value='again', create_by='y').save()
+        self.assertEqual(self.rows(), [('1', 'b', 'again', 'y')])
+        self.assertEqual(self.counts(), (1, 0, 1))
+
+    def test_save_many_after_insert_in_session(self):
+        with orm.session():
+            Setting(id='2', scope='a', value='first', create_by='y').insert()
+            Setting.save_many([Setting(id='2', scope='a', value='second', create_by='y')])
+        self.assertEqual(self.rows()[1], ('2', 'a', 'second', 'y'))
+        self.assertEqual(Setting.count_all(), 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,11 +5,19 @@ Create on :2015/12/3
 Liense :Database operation module
 '''
 
+import sys
 import time
 import threading
 import uuid
 import functools
 import logging
+import operator
+import hashlib
+import re
+import json
+import bisect
+import collections
+import itertools
 
 #Dict object
 class Dict(dict):
@@ -27,6 +35,129 @@ class Dict(dict):
     def __setattr__(self, key, value):
         self[key] = value
 
+class Row(tuple):
+    '''
+    查询结果的一行，用tuple保存字段值，字段名保存在类上
+    每种字段布局只生成一次子类（见_row_class），因此每行只占一个tuple的内存
+    支持 row[0]、row['name']、row.name 三种访问方式，keys()/values()/items()/get()
+    和Dict一样可用，as_dict()返回一个可修改的Dict
+    Row是只读的，也不是dict（json.dumps之前先as_dict()），只在select(..., compact=True)时返回
+    '''
+    __slots__ = ()
+    _names = ()
+    _index = {}
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            try:
+                key = self._index[key]
+            except KeyError:
+                raise KeyError(key)
+        return tuple.__getitem__(self, key)
+
+    def __getattr__(self, key):
+        try:
+            return tuple.__getitem__(self, self._index[key])
+        except KeyError:
+            raise AttributeError(r"'Row' Object has no attribute '%s'" % key)
+
+    def __setattr__(self, key, value):
+        raise AttributeError('Row is read-only, use as_dict() to get a mutable copy')
+
+    def __iter__(self):
+        #和dict一样，遍历得到的是字段名
+        return iter(self._names)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def has_key(self, key):
+        return key in self._index
+
+    def keys(self):
+        return list(self._names)
+
+    def values(self):
+        return list(tuple.__iter__(self))
+
+    def items(self):
+        return zip(self._names, tuple.__iter__(self))
+
+    def iterkeys(self):
+        return iter(self._names)
+
+    def itervalues(self):
+        return tuple.__iter__(self)
+
+    def iteritems(self):
+        return iter(zip(self._names, tuple.__iter__(self)))
+
+    def get(self, key, default=None):
+        i = self._index.get(key)
+        return default if i is None else tuple.__getitem__(self, i)
+
+    def as_dict(self):
+        return Dict(self._names, tuple.__iter__(self))
+
+    def __eq__(self, other):
+        if isinstance(other, dict):
+            return dict(self.iteritems()) == other
+        return tuple.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = tuple.__hash__
+
+    def __repr__(self):
+        return 'Row(%s)' % ', '.join(['%s=%r' % kv for kv in self.iteritems()])
+
+    def __reduce__(self):
+        #Row的子类是动态生成的，pickle时只保存字段名和值
+        return _unpickle_row, (self._names, tuple(tuple.__iter__(self)))
+
+#字段名元组 --> Row子类
+_row_classes = {}
+
+def _row_class(names):
+    '''
+    根据cursor.description的字段名取得对应的Row子类，同样的字段布局只生成一次
+    '''
+    names = tuple(names)
+    cls = _row_classes.get(names)
+    if cls is None:
+        attrs = dict(__slots__=(), _names=names, _index=dict([(n, i) for i, n in enumerate(names)]))
+        for i, n in enumerate(names):
+            #字段名和Row的方法重名时，只能通过row['name']访问
+            try:
+                n = str(n)
+            except UnicodeError:
+                continue
+            if not n.startswith('_') and not n in Row.__dict__:
+                attrs[n] = property(operator.itemgetter(i))
+        cls = _row_classes[names] = type('Row', (Row,), attrs)
+    return cls
+
+def _unpickle_row(names, values):
+    return _row_class(names)(values)
+
+def _description_row_class(description):
+    return _row_class([x[0] for x in description])
+
+def _row_factory(description, compact):
+    '''
+    compact为True时每行是Row，否则是Dict
+    '''
+    if compact:
+        return _description_row_class(description)
+    return functools.partial(Dict, [x[0] for x in description])
+
+def _compact_arg(kw):
+    compact = kw.pop('compact', False)
+    if kw:
+        raise TypeError('Unexpected keyword arguments: %s' % ','.join(kw))
+    return compact
+
 def next_id(t=None):
     '''
     产生一个唯一id 当前时间+伪随机数
@@ -38,16 +169,249 @@ def next_id(t=None):
     nextId = '%015d%s000' % (int(t*1000), uuid.uuid4().hex)
     return nextId
 
-def _profiling(start, sql=''):
+#统计sql执行的情况：每条语句的耗时分布、返回/影响的行数，借连接的等待时间，事务的耗时，以及慢查询
+#耗时分布的桶的上界（秒）
+_LATENCY_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+
+class _Histogram(object):
     '''
-    用于剖析sql的执行时间
-    但下划线开头的函数，不会再别的模块进行导入，只有在本模块中可以使用
+    按_LATENCY_BUCKETS分桶统计耗时，百分位数用所在桶的上界估计
     '''
-    t = time.time()
-    if t>0.1:
-        logging.warning('[PROFILING] [DB] %s:%s',(t, sql))
-    else:
-        logging.info('[PROFILING] [DB] %S:%S', (t, sql))
+    def __init__(self):
+        self.counts = [0] * (len(_LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, t):
+        self.counts[bisect.bisect_left(_LATENCY_BUCKETS, t)] += 1
+        self.count += 1
+        self.total += t
+        if t > self.max:
+            self.max = t
+
+    def percentile(self, p):
+        n = self.count * p
+        acc = 0
+        for i, c in enumerate(self.counts):
+            acc += c
+            if c and acc >= n:
+                return min(_LATENCY_BUCKETS[i], self.max) if i < len(_LATENCY_BUCKETS) else self.max
+        return self.max
+
+    def snapshot(self):
+        return Dict(count=self.count, total=self.total, max=self.max,
+                    avg=self.total / self.count if self.count else 0.0,
+                    p50=self.percentile(0.5), p95=self.percentile(0.95), p99=self.percentile(0.99),
+                    buckets=[[le, c] for le, c in zip(_LATENCY_BUCKETS + ('inf',), self.counts)])
+
+class _StatementStats(_Histogram):
+    def __init__(self):
+        super(_StatementStats, self).__init__()
+        self.rows = 0
+        self.errors = 0
+
+    def snapshot(self):
+        d = super(_StatementStats, self).snapshot()
+        d.rows = self.rows
+        d.errors = self.errors
+        return d
+
+_NORMALIZE_RULES = (
+    (re.compile(r"'(?:[^'\\]|\\.|'')*'"), '?'),
+    (re.compile(r'(?<![\w`])-?\d+(?:\.\d+)?'), '?'),
+    (re.compile(r'%s'), '?'),
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)'), '(...)'),
+    (re.compile(r'(\(\.\.\.\))(?:\s*,\s*\(\.\.\.\))+'), r'\1'),
+    (re.compile(r'\s+'), ' '),
+)
+_normalized = {}
+
+def normalize_sql(sql):
+    '''
+    把sql中的常量、占位符、in列表和多行values归一化，同一类语句得到同一个key，例如
+        select * from `users` where `id` in (%s,%s,%s)  -->  select * from `users` where `id` in (...)
+    '''
+    key = _normalized.get(sql)
+    if key is None:
+        key = sql
+        for pattern, repl in _NORMALIZE_RULES:
+            key = pattern.sub(repl, key)
+        key = key.strip()
+        if len(_normalized) >= 2000:
+            _normalized.clear()
+        _normalized[sql] = key
+    return key
+
+def _sql_text(sql):
+    '''
+    CompiledSQL/CompiledUnicode转换成普通的str/unicode
+    '''
+    return unicode(sql) if isinstance(sql, unicode) else str(sql)
+
+class _Metrics(object):
+    '''
+    全局的统计，enabled为False时不做任何记录
+    @slow_threshold :超过这个秒数的语句记入慢查询日志，并用logging.warning输出
+    @slow_log_size :保留最近的慢查询条数
+    '''
+    def __init__(self, slow_threshold=0.1, slow_log_size=100):
+        self.enabled = True
+        self.slow_threshold = slow_threshold
+        self._lock = threading.Lock()
+        self.statements = {}
+        self.checkout_wait = _Histogram()
+        self.transactions = _Histogram()
+        self.commits = 0
+        self.rollbacks = 0
+        self.slow_log = collections.deque(maxlen=slow_log_size)
+
+    def reset(self):
+        with self._lock:
+            self.statements = {}
+            self.checkout_wait = _Histogram()
+            self.transactions = _Histogram()
+            self.commits = 0
+            self.rollbacks = 0
+            self.slow_log.clear()
+
+    def record(self, sql, elapsed, rows, ok=True):
+        key = normalize_sql(sql)
+        with self._lock:
+            stats = self.statements.get(key)
+            if stats is None:
+                stats = self.statements[key] = _StatementStats()
+            stats.observe(elapsed)
+            if ok:
+                stats.rows += max(rows, 0) #ddl语句的rowcount是-1
+            else:
+                stats.errors += 1
+        if elapsed >= self.slow_threshold:
+            logging.warning('[SLOW SQL] %.3fs %s', elapsed, sql)
+            self.slow_log.append(Dict(sql=_sql_text(sql), elapsed=elapsed, rows=rows, ok=ok, at=time.time()))
+
+    def record_checkout(self, elapsed):
+        with self._lock:
+            self.checkout_wait.observe(elapsed)
+
+    def record_transaction(self, elapsed, committed):
+        with self._lock:
+            self.transactions.observe(elapsed)
+            if committed:
+                self.commits += 1
+            else:
+                self.rollbacks += 1
+
+    def snapshot(self):
+        with self._lock:
+            transactions = self.transactions.snapshot()
+            transactions.commits = self.commits
+            transactions.rollbacks = self.rollbacks
+            return Dict(statements=dict((k, v.snapshot()) for k, v in self.statements.iteritems()),
+                        checkout_wait=self.checkout_wait.snapshot(),
+                        transactions=transactions,
+                        slow_threshold=self.slow_threshold,
+                        slow_queries=list(self.slow_log))
+
+metrics = _Metrics()
+
+class _Tracer(object):
+    '''
+    sql跟踪，缺省关闭，关闭时每条语句只多一次属性判断
+    @sample_rate :每N条语句记录一条，0表示不按比例采样
+    @slower_than :耗时不少于这个秒数的语句总是记录，None表示不按耗时采样；出错的语句总是记录
+    @size :环形缓冲区保留的最近条数
+    记录的是原始的(sql, args)，只有dump()/format()时才格式化
+    '''
+    def __init__(self, size=200):
+        self.enabled = False
+        self.sample_rate = 1
+        self.slower_than = None
+        self.buffer = collections.deque(maxlen=size)
+        self.hooks = []
+        self._counter = itertools.count()
+
+    def trace(self, sql, args, elapsed, rows, ok):
+        if not ok or (self.slower_than is not None and elapsed >= self.slower_than) \
+                or (self.sample_rate and next(self._counter) % self.sample_rate == 0):
+            entry = (time.time(), sql, args, elapsed, rows, ok)
+            self.buffer.append(entry)
+            for hook in self.hooks:
+                try:
+                    hook(*entry)
+                except Exception, e:
+                    logging.exception('trace hook %r failed: %s' % (hook, e))
+
+    def dump(self):
+        return [Dict(at=at, sql=_sql_text(sql), args=args, elapsed=elapsed, rows=rows, ok=ok)
+                for at, sql, args, elapsed, rows, ok in list(self.buffer)]
+
+    def format(self):
+        return '\n'.join(['%s %.3fs rows=%s%s SQL:%s ,ARGS:%r' % (time.strftime('%H:%M:%S', time.localtime(at)), elapsed, rows, '' if ok else ' ERROR', sql, args)
+                          for at, sql, args, elapsed, rows, ok in list(self.buffer)])
+
+tracer = _Tracer()
+
+def enable_tracing(sample_rate=1, slower_than=None, size=None):
+    '''
+    开启sql跟踪，例如 enable_tracing(sample_rate=100, slower_than=0.05)
+    每100条记录1条，另外所有超过50ms的语句都记录
+    '''
+    tracer.sample_rate = sample_rate
+    tracer.slower_than = slower_than
+    if size is not None and size != tracer.buffer.maxlen:
+        tracer.buffer = collections.deque(tracer.buffer, maxlen=size)
+    tracer.enabled = True
+
+def disable_tracing():
+    tracer.enabled = False
+
+def add_trace_hook(func):
+    '''
+    注册一个函数func(at, sql, args, elapsed, rows, ok)，每条被采样的语句记录后调用
+    '''
+    tracer.hooks.append(func)
+
+def trace_dump():
+    '''
+    返回环形缓冲区中最近的语句，出错时可以记入日志，例如
+        except Exception:
+            logging.error('recent sql:\n%s', db.format_trace())
+    '''
+    return tracer.dump()
+
+def format_trace():
+    return tracer.format()
+
+def _record(sql, args, start, rows, ok):
+    if metrics.enabled or tracer.enabled:
+        elapsed = time.time() - start
+        if metrics.enabled:
+            metrics.record(sql, elapsed, rows, ok)
+        if tracer.enabled:
+            tracer.trace(sql, args, elapsed, rows, ok)
+
+def set_slow_query_threshold(seconds):
+    metrics.slow_threshold = seconds
+
+def metrics_snapshot():
+    '''
+    返回当前的统计：statements（归一化的sql --> 次数、耗时分布、行数、错误数）、checkout_wait、
+    transactions（含commits/rollbacks）、slow_threshold和slow_queries
+    '''
+    return metrics.snapshot()
+
+def reset_metrics():
+    metrics.reset()
+
+def metrics_app(environ, start_response):
+    '''
+    以json输出metrics_snapshot()的WSGI应用，可以挂在管理端口上，例如
+        wsgiref.simple_server.make_server('127.0.0.1', 9001, db.metrics_app).serve_forever()
+    '''
+    body = json.dumps(metrics_snapshot(), indent=2, sort_keys=True)
+    start_response('200 OK', [('Content-Type', 'application/json'), ('Content-Length', str(len(body)))])
+    return [body]
 
 class DBError(Exception):
     pass
@@ -58,26 +422,283 @@ class MultiColumnsError(DBError):
 #glabol engine object 保存着数据库的连接
 engine = None
 
+class PoolTimeoutError(DBError):
+    pass
+
+class _ConnectionPool(object):
+    '''
+    有界连接池，复用已经建立好的数据库连接，避免每次with connection()都重新握手
+    @min_size :初始化时预先建立的连接数
+    @max_size :池中最多保留的空闲连接数
+    @max_overflow :超过max_size后还允许临时创建的连接数，归还时直接关闭
+    @timeout :连接全部借出时，等待归还的最长秒数，超时抛出PoolTimeoutError
+    @recycle :连接的最大存活秒数，超过后借出时重新连接，<=0表示不限制
+    @pre_ping :借出前先ping一次，失效的连接会被丢弃并重新连接；每次借出多一次往返，缺省关闭，
+               连接经常被服务器断开（比如wait_timeout较短）时再打开
+    '''
+    def __init__(self, connect, min_size=0, max_size=10, max_overflow=5, timeout=30, recycle=3600, pre_ping=False):
+        if max_size < 1 or min_size < 0 or min_size > max_size or max_overflow < 0:
+            raise DBError('Bad pool size: min=%s, max=%s, overflow=%s' % (min_size, max_size, max_overflow))
+        self._connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_overflow = max_overflow
+        self.timeout = timeout
+        self.recycle = recycle
+        self.pre_ping = pre_ping
+        self._cond = threading.Condition(threading.Lock())
+        self._idle = [] #空闲连接，后进先出，建立的时间记录在_created中
+        self._created = {} #id(connection) --> created_at，记录所有打开的连接
+        self._size = 0 #已打开以及正在建立的连接数
+        self._stats = dict(checkouts=0, checkins=0, connects=0, closes=0, waits=0, timeouts=0, recycled=0, ping_failures=0)
+        for i in range(min_size):
+            conn = self._open()
+            self._idle.append(conn)
+
+    def _open(self):
+        conn = self._connect()
+        self._created[id(conn)] = time.time()
+        self._size += 1
+        self._stats['connects'] += 1
+        return conn
+
+    def _close(self, conn):
+        self._created.pop(id(conn), None)
+        self._size -= 1
+        self._stats['closes'] += 1
+        try:
+            conn.close()
+        except Exception, e:
+            logging.warning('close pooled connection <%s> failed: %s' % (hex(id(conn)), e))
+
+    def _expired(self, conn):
+        return self.recycle > 0 and time.time() - self._created.get(id(conn), 0) > self.recycle
+
+    def _alive(self, conn):
+        try:
+            conn.ping()
+            return True
+        except Exception, e:
+            logging.warning('ping connection <%s> failed: %s' % (hex(id(conn)), e))
+            self._stats['ping_failures'] += 1
+            return False
+
+    def acquire(self, timeout=None):
+        '''
+        借出一个连接，优先使用空闲连接，没有空闲时在上限内新建，否则等待归还
+        timeout为最长等待的秒数，缺省为连接池的timeout，0表示不等待
+        '''
+        start = time.time()
+        conn = self._checkout(self.timeout if timeout is None else timeout)
+        if metrics.enabled:
+            metrics.record_checkout(time.time() - start)
+        return conn
+
+    def _checkout(self, timeout):
+        deadline = None
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn = self._idle.pop()
+                    break
+                if self._size < self.max_size + self.max_overflow:
+                    #先占位，连接在锁外建立
+                    conn = None
+                    self._size += 1
+                    break
+                if deadline is None:
+                    deadline = time.time() + timeout
+                    self._stats['waits'] += 1
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolTimeoutError('No connection available in %s seconds' % timeout)
+                self._cond.wait(remaining)
+            self._stats['checkouts'] += 1
+        if conn is None:
+            return self._reserve(None)
+        if self._expired(conn):
+            self._stats['recycled'] += 1
+            return self._reserve(conn)
+        if self.pre_ping and not self._alive(conn):
+            return self._reserve(conn)
+        return conn
+
+    def _reserve(self, stale):
+        '''
+        在锁外建立新连接，替换占位或失效的连接
+        '''
+        if stale is not None:
+            #失效连接的名额直接留给新连接
+            with self._cond:
+                self._close(stale)
+                self._size += 1
+        try:
+            conn = self._connect()
+        except:
+            with self._cond:
+                self._size -= 1
+                self._stats['checkouts'] -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._created[id(conn)] = time.time()
+            self._stats['connects'] += 1
+        return conn
+
+    def release(self, conn):
+        '''
+        归还连接，未提交的事务回滚掉，超出max_size的连接直接关闭
+        '''
+        try:
+            conn.rollback()
+            reusable = not self._expired(conn)
+        except Exception, e:
+            logging.warning('reset connection <%s> failed: %s' % (hex(id(conn)), e))
+            reusable = False
+        with self._cond:
+            self._stats['checkins'] += 1
+            if reusable and len(self._idle) < self.max_size:
+                self._idle.append(conn)
+            else:
+                self._close(conn)
+            self._cond.notify()
+
+    def discard(self, conn):
+        '''
+        关闭一个借出的连接，不放回池中，用于状态不确定的连接（比如还有未读完的结果集）
+        '''
+        with self._cond:
+            self._stats['checkins'] += 1
+            self._close(conn)
+            self._cond.notify()
+
+    def dispose(self):
+        '''
+        关闭所有空闲连接，借出的连接归还后照常处理
+        '''
+        with self._cond:
+            idle, self._idle = self._idle, []
+            for conn in idle:
+                self._close(conn)
+
+    def busy(self):
+        '''
+        借出中的连接数
+        '''
+        return self._size - len(self._idle)
+
+    def stats(self):
+        with self._cond:
+            d = Dict(**self._stats)
+            d.size = self._size
+            d.idle = len(self._idle)
+            d.checked_out = d.size - d.idle
+            d.overflow = max(0, d.size - self.max_size)
+            d.max_size = self.max_size
+            d.max_overflow = self.max_overflow
+            return d
+
 class _Engine(object):
     '''
     数据库引擎对象
-    功能：用来保存create_engine创建出来的数据库链接
+    功能：用来保存create_engine创建出来的数据库连接池
     '''
-    def __init__(self, connect):
+    def __init__(self, connect, **pool_kw):
         self._conect = connect
+        self.pool = _ConnectionPool(connect, **pool_kw)
+
+    def connect(self, timeout=None):
+        return self.pool.acquire(timeout) #从连接池借出一个连接
+
+    def release(self, connection):
+        self.pool.release(connection)
+
+    def discard(self, connection):
+        self.pool.discard(connection)
+
+#只读副本，没有配置时为None，读操作都走engine
+replicas = None
+
+class _ReplicaSet(object):
+    '''
+    一组只读副本的engine，按round_robin（轮询）或least_busy（借出连接最少）选择
+    连接失败的副本在retry秒内不再使用，全部不可用时退回到主库
+    '''
+    def __init__(self, engines, strategy='round_robin', retry=30):
+        if not strategy in ('round_robin', 'least_busy'):
+            raise DBError('Unknown replica strategy: %s' % strategy)
+        self.engines = list(engines)
+        self.strategy = strategy
+        self.retry = retry
+        self._down = {} #id(engine) --> 恢复尝试的时间
+        self._next = 0
+
+    def _candidates(self):
+        now = time.time()
+        alive = [e for e in self.engines if self._down.get(id(e), 0) <= now]
+        if self.strategy == 'least_busy':
+            alive.sort(key=lambda e: e.pool.busy())
+        elif alive:
+            self._next = (self._next + 1) % len(alive)
+            alive = alive[self._next:] + alive[:self._next]
+        return alive
+
+    def mark_down(self, e):
+        self._down[id(e)] = time.time() + self.retry
 
     def connect(self):
-        return self._conect() #这里传参为一个函数，调用函数后将结果返回
+        '''
+        返回(engine, connection)，依次尝试可用的副本，都失败时从主库借连接
+        副本的连接池满了不等待，直接尝试下一个副本，只有从主库借连接时才等待
+        '''
+        for e in self._candidates():
+            try:
+                conn = e.connect(0)
+            except PoolTimeoutError:
+                continue #连接池满了，不代表副本不可用
+            except Exception, ex:
+                logging.warning('replica <%s> is down: %s' % (hex(id(e)), ex))
+                self.mark_down(e)
+                continue
+            self._down.pop(id(e), None)
+            return e, conn
+        logging.warning('no replica available, read from primary')
+        return engine, engine.connect()
+
+    def stats(self):
+        now = time.time()
+        L = []
+        for e in self.engines:
+            d = e.pool.stats()
+            d.down = self._down.get(id(e), 0) > now
+            L.append(d)
+        return L
+
+#命名的engine，name --> _Engine，用于分片，通过using(name)切换
+engines = {}
 
-def create_engine(user, password, database, host='127.0.0.1', port=3306, **kw):
+def create_engine(user, password, database, host='127.0.0.1', port=3306,
+                  pool_min_size=0, pool_max_size=10, pool_max_overflow=5,
+                  pool_timeout=30, pool_recycle=3600, pool_pre_ping=False,
+                  replicas=(), replica_strategy='round_robin', replica_retry=30, name=None, **kw):
     '''
     db的核心函数，用于连接数据库，生成全局对象engine
-    engine对象持有数据库的连接
+    engine对象持有数据库的连接池，pool_*参数见_ConnectionPool
+    replicas是只读副本的列表，每个元素是一个dict，覆盖主库的连接参数（比如host、port），
+    事务外的select/select_one/select_int会分发到副本，replica_*参数见_ReplicaSet
+    写过之后读主库（read-your-writes）只在同一个connection()中有效，web应用需要用
+    connection_middleware（或者给handler加with_connection）让每个请求在一个connection()中处理
+    name不为None时创建一个命名的engine（比如一个分片），保存在engines中，不影响全局的engine
     '''
     import mysql.connector
     global engine
-    if engine is not None:
+    if name is None and engine is not None:
         raise DBError('Engine is already initialized')#如果已经连接，表示连接重复
+    if name is not None and name in engines:
+        raise DBError('Engine %s is already initialized' % name)
+    if name is not None and replicas:
+        raise DBError('Replicas are only supported on the default engine')
 
     #保存数据库的连接信息
     params = dict(user=user, password=password, database=database, host=host, port=port)
@@ -88,11 +709,80 @@ def create_engine(user, password, database, host='127.0.0.1', port=3306, **kw):
         params[k] = kw.pop(k,v)
     params.update(kw)
     params['buffered'] = True
-    engine = _Engine(lambda:mysql.connector.connect(**params))#这里返回的是一个函数
+    pool_kw = dict(min_size=pool_min_size, max_size=pool_max_size, max_overflow=pool_max_overflow,
+                   timeout=pool_timeout, recycle=pool_recycle, pre_ping=pool_pre_ping)
+    e = _Engine(lambda:mysql.connector.connect(**params), **pool_kw)
+    if name is not None:
+        engines[name] = e
+        logging.info('init engine %s <%s> is ok.' % (name, hex(id(e))))
+        return
+    engine = e
+    if replicas:
+        replica_engines = []
+        for replica in replicas:
+            replica_params = dict(params, **replica)
+            replica_engines.append(_Engine(lambda p=replica_params: mysql.connector.connect(**p), **pool_kw))
+        set_replicas(replica_engines, replica_strategy, replica_retry)
 
     #test connection
     logging.info('init engine <%s> is ok.' % hex(id(engine)))
 
+def set_replicas(engines, strategy='round_robin', retry=30):
+    '''
+    设置只读副本，engines是_Engine的列表，传入空列表表示取消
+    测试时可以用本地的替身数据库创建_Engine
+    '''
+    global replicas
+    replicas = _ReplicaSet(engines, strategy, retry) if engines else None
+
+def replica_stats():
+    '''
+    返回每个只读副本的连接池统计，以及是否被标记为不可用（down）
+    '''
+    return replicas.stats() if replicas else []
+
+def _get_engine(name):
+    if name is None:
+        return engine
+    try:
+        return engines[name]
+    except KeyError:
+        raise DBError('Engine %s is not initialized' % name)
+
+class ShardRouter(object):
+    '''
+    按分片键把数据分配到命名的engine上：md5(key)的前32位 % 分片数（crc32的低位对相近的键分布不均）
+    '''
+    def __init__(self, names):
+        if not names:
+            raise DBError('ShardRouter needs at least one engine')
+        self.names = list(names)
+
+    def shard_for(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return self.names[int(hashlib.md5(str(key)).hexdigest()[:8], 16) % len(self.names)]
+
+#缺省的分片路由，见set_shard_router
+shard_router = None
+
+def set_shard_router(router):
+    '''
+    设置缺省的分片路由，router可以是ShardRouter，也可以是engine名字的列表
+    '''
+    global shard_router
+    if router is not None and not isinstance(router, ShardRouter):
+        router = ShardRouter(router)
+    shard_router = router
+
+def pool_stats():
+    '''
+    返回连接池的统计信息：size/idle/checked_out/overflow以及借出、等待、超时等计数
+    '''
+    if engine is None:
+        raise DBError('Engine is not initialized')
+    return engine.pool.stats()
+
 
 #以上操作是，通过数据库引擎engine这个全局变量就可以获得一个数据库链接，重复连接会报错。
 
@@ -101,28 +791,36 @@ class _LasyConnection(object):
     '''
     惰性连接，仅当需要cursor时，才连接数据库，获取连接
     '''
-    def __init__(self):
+    def __init__(self, route=None):
         self.connection = None
+        self.engine = None
+        self._route = route #返回(engine, connection)的函数，缺省从全局engine借连接
 
-    def cursor(self):
+    def cursor(self, **kw):
         if self.connection is None:
-            connection = engine.connect()
-            logging.info('open connection <%s>..' % hex(id(connection)))
+            if self._route:
+                self.engine, connection = self._route()
+            else:
+                self.engine, connection = engine, engine.connect()
+            logging.debug('borrow connection <%x>..', id(connection))
             self.connection = connection
-        return self.connection.cursor()
+        return self.connection.cursor(**kw)
 
     def commit(self):
-        self.connection.commit()
+        #还没有执行过sql时没有借出连接，不需要提交
+        if self.connection:
+            self.connection.commit()
 
     def rollback(self):
-        self.connection.rollback()
+        if self.connection:
+            self.connection.rollback()
 
     def clearup(self):
         if self.connection:
             connection = self.connection
             self.connection = None
-            logging.info('close connection <%s>' % hex(id(connection)))
-            connection.close()
+            logging.debug('release connection <%x>', id(connection))
+            self.engine.release(connection)
 
  #以下的操作是针对不同的线程数据库链接应该是不一样的，于是创建一个变量threadlocal
 class _DbCtx(threading.local):
@@ -132,19 +830,43 @@ class _DbCtx(threading.local):
     '''
     def __init__(self):
         self.connection = None
+        self.replica = None #读副本的惰性连接，没有配置副本时为None
+        self.pinned = False #执行过写操作后，本次上下文中的读都走主库（read-your-writes）
+        self.primary_reads = 0 #大于0时读都走主库，见read_primary
         self.transcations = 0
+        self.identity = None #ORM的identity map，生命周期和最外层的connection()/transaction()一致
+        self.callbacks = [] #最外层事务结束时调用的函数，见after_transaction
+        self.pre_commit = [] #最外层事务提交之前调用的函数，见before_commit
+        self.engine_name = None #当前使用的命名engine，None为全局的engine，见using
+        self.enlisted = None #事务中用到的其他engine，见_Enlisted
 
     def is_init(self):
         return self.connection is not None #判断是否已经初始化
 
     def init(self):
-        logging.info('open lazy connection...')
-        self.connection = _LasyConnection()#打开了一个数据库的链接
+        logging.debug('open lazy connection...')
+        if self.engine_name is None:
+            self.connection = _LasyConnection()#打开了一个数据库的链接
+            self.replica = _LasyConnection(replicas.connect) if replicas else None
+        else:
+            e = _get_engine(self.engine_name)
+            self.connection = _LasyConnection(lambda: (e, e.connect()))
+            self.replica = None
+        self.pinned = False
         self.transcations = 0
+        self.identity = {}
+        self.callbacks = []
+        self.pre_commit = []
 
     def clearup(self):
         self.connection.clearup()
         self.connection = None
+        if self.replica:
+            self.replica.clearup()
+            self.replica = None
+        self.identity = None
+        self.callbacks = []
+        self.pre_commit = []
 
     def cursor(self):
         '''return cursor'''
@@ -155,6 +877,192 @@ class _DbCtx(threading.local):
 _db_ctx = _DbCtx()
 #通过_DbCtx就可以操控数据库的连接和关闭
 
+class _EngineCtx(object):
+    '''
+    切换当前线程使用的engine，原来的连接、事务等状态先保存起来，退出时恢复
+    '''
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.saved = None
+        self.enlisted = None
+        if _db_ctx.engine_name != self.name:
+            _get_engine(self.name)
+            if _db_ctx.transcations > 0:
+                #在事务中切换engine：加入外层事务，随外层事务一起提交或回滚
+                self.enlisted = _Enlisted.of(_db_ctx)
+            self.saved = _db_ctx.__dict__.copy()
+            if self.enlisted is not None:
+                self.enlisted.enter(self.name)
+            else:
+                _db_ctx.__init__()
+                _db_ctx.engine_name = self.name
+        return self
+
+    def __exit__(self, type, value, trace):
+        if self.saved is not None:
+            try:
+                if self.enlisted is not None:
+                    self.enlisted.leave(self.name)
+                elif _db_ctx.is_init():
+                    _db_ctx.clearup()
+            finally:
+                _db_ctx.__dict__.clear()
+                _db_ctx.__dict__.update(self.saved)
+
+class _Enlisted(object):
+    '''
+    事务中通过using用到的其他engine：每个engine在第一次用到时开始一个事务，
+    外层事务提交之前依次提交，外层事务回滚（或者提交前出错）时回滚还没有提交的engine
+    注意这不是两阶段提交，提交到一半出错时，已经提交的engine不能再回滚
+    '''
+    def __init__(self, pre_commit):
+        self.pre_commit = pre_commit #外层事务的before_commit列表
+        self.states = collections.OrderedDict() #engine名 -> 该engine的_db_ctx状态
+        self.committed = set()
+
+    @classmethod
+    def of(cls, ctx):
+        if ctx.enlisted is None:
+            ctx.enlisted = cls(ctx.pre_commit)
+            ctx.callbacks.append(ctx.enlisted.finish)
+        return ctx.enlisted
+
+    def enter(self, name):
+        _db_ctx.__dict__.clear()
+        if name in self.states:
+            _db_ctx.__dict__.update(self.states[name])
+        else:
+            _db_ctx.__init__()
+            _db_ctx.engine_name = name
+            _db_ctx.enlisted = self
+            _db_ctx.init()
+            _db_ctx.transcations = 1
+        #提交之后又用到的engine需要再提交一次
+        self.committed.discard(name)
+        if self.commit not in self.pre_commit:
+            self.pre_commit.append(self.commit)
+
+    def leave(self, name):
+        self.states[name] = _db_ctx.__dict__.copy()
+
+    def _run(self, name, func):
+        saved = _db_ctx.__dict__.copy()
+        _db_ctx.__dict__.clear()
+        _db_ctx.__dict__.update(self.states[name])
+        try:
+            func()
+        finally:
+            self.leave(name)
+            _db_ctx.__dict__.clear()
+            _db_ctx.__dict__.update(saved)
+
+    def commit(self):
+        def run():
+            _run_pre_commit()
+            logging.debug('commit enlisted transaction on engine %s...', _db_ctx.engine_name)
+            _db_ctx.connection.commit()
+        for name in self.states.keys():
+            if name not in self.committed:
+                self._run(name, run)
+                self.committed.add(name)
+
+    def finish(self, committed):
+        def run(ok):
+            try:
+                if not ok:
+                    logging.warning('rollback enlisted transaction on engine %s ...', _db_ctx.engine_name)
+                    _db_ctx.connection.rollback()
+            finally:
+                _db_ctx.pre_commit = []
+                _run_callbacks(ok)
+                _db_ctx.clearup()
+        try:
+            for name in self.states.keys():
+                ok = committed and name in self.committed
+                try:
+                    self._run(name, lambda: run(ok))
+                except Exception, e:
+                    logging.exception('finish enlisted transaction on engine %s failed: %s' % (name, e))
+        finally:
+            self.states.clear()
+            _db_ctx.enlisted = None
+
+def current_engine():
+    '''
+    当前线程使用的命名engine，None为全局的engine
+    '''
+    return _db_ctx.engine_name
+
+def using(name):
+    '''
+    在with语句中使用命名的engine（name为None时为全局的engine），例如
+        with db.using('shard1'):
+            db.select(...)
+    在外层事务中使用别的engine时，该engine的写操作加入外层事务，随外层事务一起提交或回滚
+    '''
+    return _EngineCtx(name)
+
+class _PrimaryCtx(object):
+    def __enter__(self):
+        _db_ctx.primary_reads += 1
+        return self
+
+    def __exit__(self, type, value, trace):
+        _db_ctx.primary_reads -= 1
+
+def read_primary():
+    '''
+    在with语句中的读都走主库，不分发到只读副本。结果要放进缓存的查询用它读：
+    副本有延迟，刚写过之后从副本读到的旧数据会被当成新数据缓存起来
+    '''
+    return _PrimaryCtx()
+
+#并行执行用的线程池，第一次使用时创建
+_workers = None
+_workers_lock = threading.Lock()
+WORKERS = 8
+
+class _PoolThread(threading.local):
+    '''
+    线程池的工作线程上记录所属的线程池。在工作线程中再向同一个线程池提交任务并等待结果时，
+    任务直接在当前线程执行，否则工作线程都在等排队的任务，线程池会死锁
+    '''
+    def __init__(self):
+        self.pool = None
+
+_pool_thread = _PoolThread()
+
+def _init_pool_thread(name):
+    _pool_thread.pool = name
+
+def _worker_pool():
+    global _workers
+    if _workers is None:
+        with _workers_lock:
+            if _workers is None:
+                from multiprocessing.pool import ThreadPool
+                _workers = ThreadPool(WORKERS, _init_pool_thread, ('shards',))
+    return _workers
+
+def on_shards(func, names=None):
+    '''
+    在每个命名engine上并行执行func()，按names的顺序返回结果列表，任何一个出错时抛出异常
+    names缺省为shard_router中的所有分片
+    '''
+    if names is None:
+        if shard_router is None:
+            raise DBError('Shard router is not initialized')
+        names = shard_router.names
+    def run(name):
+        with using(name):
+            return func()
+    if _pool_thread.pool == 'shards' or _db_ctx.transcations > 0:
+        #事务中串行执行，各分片才能加入当前线程的事务
+        return map(run, names)
+    return _worker_pool().map(run, names)
+
 #通过with语句，可以让数据库自动创建连接和关闭
 class _ConnectionCtx(object):
     '''
@@ -202,47 +1110,130 @@ def with_connection(func):
             return func(*args, **kw)
     return wrapper
 
+def connection_middleware(app):
+    '''
+    WSGI中间件，每个请求在一个connection()中处理，连接一直保持到响应的内容输出完
+    有只读副本时，请求中写过之后的读都走主库；不在connection()中时每条sql单独借连接，
+    insert之后紧接着的select可能读到还没有同步的副本
+        application = db.connection_middleware(application)
+    '''
+    def wrapper(environ, start_response):
+        with connection():
+            body = app(environ, start_response)
+            try:
+                for chunk in body:
+                    yield chunk
+            finally:
+                if hasattr(body, 'close'):
+                    body.close()
+    return wrapper
+
 #下面是处理事务
 class _TransactionCtx(object):
-    def __init__(self):
+    def __enter__(self):
         global _db_ctx
         self.should_close_conn = False
         if not _db_ctx.is_init():
             _db_ctx.init()
             self.should_close_conn = True
         _db_ctx.transcations = _db_ctx.transcations+1
-        logging.info('begin transaction ...'if _db_ctx.transcations==1 else 'join current')
+        logging.debug('begin transaction ...'if _db_ctx.transcations==1 else 'join current')
+        self.start = time.time()
         return self
 
     def __exit__(self, type, value, trace):
         global _db_ctx
+        error = None
+        if type is None and _db_ctx.transcations == 1:
+            #提交前的函数仍然在事务中执行，出错时回滚并抛出异常
+            try:
+                _run_pre_commit()
+            except:
+                error = sys.exc_info()
         _db_ctx.transcations = _db_ctx.transcations-1
         try:
             if _db_ctx.transcations == 0:
-                if type is None:
-                    self.commit()
-                else:
-                    self.rollback()
+                committed = False
+                try:
+                    if type is None and error is None:
+                        committed = self.commit()
+                    else:
+                        self.rollback()
+                finally:
+                    _db_ctx.pre_commit = []
+                    if metrics.enabled:
+                        metrics.record_transaction(time.time() - self.start, committed)
+                    _run_callbacks(committed)
         finally:
             if self.should_close_conn:
                 _db_ctx.clearup()
+        if error is not None:
+            raise error[0], error[1], error[2]
 
     def commit(self):
         global _db_ctx
-        logging.info('commit transaction...')
+        logging.debug('commit transaction...')
         try:
             _db_ctx.connection.commit()
-            logging.info('comit ok')
+            logging.debug('comit ok')
+            return True
         except:
             logging.warning('commit fail, try rollback')
-            _db_ctx.connection.rollback() #遇到故障时候，事务回滚到事务一开始的状态
+            self.rollback() #遇到故障时候，事务回滚到事务一开始的状态
             logging.warning('rollback ok')
+            return False
 
     def rollback(self):
         global _db_ctx
         logging.warning('rollback transaction ...')
         _db_ctx.connection.rollback()
-        logging.info('rollback ok....')
+        #事务中读取或修改过的实例已经不可信，清空identity map
+        if _db_ctx.identity:
+            _db_ctx.identity.clear()
+        logging.debug('rollback ok....')
+
+def _run_pre_commit():
+    while _db_ctx.pre_commit:
+        func = _db_ctx.pre_commit.pop(0)
+        func()
+
+def _run_callbacks(committed):
+    callbacks, _db_ctx.callbacks = _db_ctx.callbacks, []
+    for func in callbacks:
+        try:
+            func(committed)
+        except Exception, e:
+            logging.exception('transaction callback %r failed: %s' % (func, e))
+
+def after_transaction(func):
+    '''
+    注册一个函数func(committed)，在当前最外层事务提交或回滚之后调用
+    不在事务中时立即以func(True)调用
+    '''
+    if _db_ctx.transcations > 0:
+        _db_ctx.callbacks.append(func)
+    else:
+        func(True)
+
+def before_commit(func):
+    '''
+    注册一个无参数的函数，在当前最外层事务提交之前、仍在事务中时调用，事务回滚时不调用
+    不在事务中时立即调用
+    '''
+    if _db_ctx.transcations > 0:
+        _db_ctx.pre_commit.append(func)
+    else:
+        func()
+
+def in_transaction():
+    return _db_ctx.transcations > 0
+
+def identity_map():
+    '''
+    返回当前线程connection()/transaction()上下文中的identity map（一个dict），
+    不在上下文中时返回None
+    '''
+    return _db_ctx.identity
 
 def transaction():
     '''
@@ -253,59 +1244,160 @@ def transaction():
 
 def with_transaction(func):
     def wrapper(*args, **kw):
-        _start = time.time()
         with transaction():
             return func(*args, **kw)
-        _profiling(_start)
     return wrapper
 
 
+class CompiledSQL(str):
+    '''
+    已经把占位符'?'替换成驱动使用的'%s'的sql文本
+    '''
+    pass
+
+class CompiledUnicode(unicode):
+    '''
+    unicode的CompiledSQL，sql中有非ascii字符时不能转换成str
+    '''
+    pass
+
+def compile_sql(sql):
+    '''
+    把'?'占位符的sql转换成驱动可以直接执行的CompiledSQL（unicode的sql为CompiledUnicode），已经转换过的原样返回
+    预先转换好的sql在执行时不再做字符串替换
+    '''
+    if isinstance(sql, (CompiledSQL, CompiledUnicode)):
+        return sql
+    if isinstance(sql, unicode):
+        return CompiledUnicode(sql.replace(u'?', u'%s'))
+    return CompiledSQL(sql.replace('?', '%s'))
+
 #基本操作数据库
-def _select(sql, first, *args):
+def _read_connection():
+    '''
+    事务外、并且本次上下文中没有写过的读操作走只读副本，否则走主库
+    "本次上下文"是最外层的connection()，没有打开connection()时每条sql都是单独的上下文
+    '''
+    if _db_ctx.replica is not None and _db_ctx.transcations == 0 and not _db_ctx.pinned and not _db_ctx.primary_reads:
+        return _db_ctx.replica
+    return _db_ctx.connection
+
+def _select(sql, first, compact, *args):
     global _db_ctx
     cursor = None
-    sql = sql.replace('?', '%s')
-    logging.info('SQL:%s ,ARGS:%s' %(sql, args))
+    sql = compile_sql(sql)
+    logging.debug('SQL:%s ,ARGS:%s', sql, args)
+    start = time.time()
+    rows = 0
+    ok = False
     try:
-        cursor = _db_ctx.connection.cursor()
+        cursor = _read_connection().cursor()
         cursor.execute(sql, args)
-        if cursor.description:
-            names=[x[0] for x in cursor.description]#返回字段名的列表
+        row = _row_factory(cursor.description, compact) #compact时同样的字段布局共用一个Row类
         if first:
             values=cursor.fetchone()
+            ok = True
             if not values:
                 return None
-            return Dict(names, values)
-        return [Dict(names, x) for x in cursor.fetchall()]
+            rows = 1
+            return row(values)
+        L = map(row, cursor.fetchall())
+        rows = len(L)
+        ok = True
+        return L
     finally:
         if cursor:
             cursor.close()
+        _record(sql, args, start, rows, ok)
 
 @with_connection
-def select_one(sql, *args):
+def select_one(sql, *args, **kw):
     '''
     execute select sql and expected one result
     if no result found,return None
     if Multiple result found, the first one returned
+    可选参数compact=True时返回只读的Row（见Row），否则返回Dict
     '''
-    return _select(sql, True, *args)
+    return _select(sql, True, _compact_arg(kw), *args)
 
 @with_connection
 def select_int(sql, *args):
     '''
     execute select sql and expected one int and only onr int result
     '''
-    d = _select(sql, True, *args)
+    d = _select(sql, True, True, *args)
     if len(d) != 1:
         raise MultiColumnsError('Expect only one column')
     return d.values()[0]
 
 @with_connection
-def select(sql, *args):
+def select(sql, *args, **kw):
     '''
     execute select sql return list or empty list if no result
+    每行是Dict；可选参数compact=True时每行是只读的Row，大结果集占用的内存少很多
     '''
-    return _select(sql, False, args)
+    return _select(sql, False, _compact_arg(kw), *args)
+
+def iter_select(sql, *args, **kw):
+    '''
+    流式查询，返回一个生成器，每次用fetchmany取batch_size行，逐行yield，不会一次把结果集读进内存
+    使用非缓冲的cursor，连接一直占用到生成器遍历结束或者被close()，提前close()时借来的连接直接关闭，不放回连接池
+    在事务中使用事务的连接，此时遍历结束前不能在同一线程执行别的sql；
+    不在事务中则单独从连接池（有只读副本时从副本）借一个连接，遍历过程中可以照常执行别的sql
+    可选参数using指定从哪个命名engine借连接（不切换当前线程的engine），compact同select
+    '''
+    batch_size = kw.pop('batch_size', 500)
+    name = kw.pop('using', None)
+    compact = _compact_arg(kw)
+    sql = compile_sql(sql)
+    logging.debug('SQL:%s ,ARGS:%s', sql, args)
+    own = _db_ctx.transcations == 0 or (name is not None and name != _db_ctx.engine_name)
+    if not own:
+        conn = _db_ctx.connection
+    elif name is not None:
+        owner = _get_engine(name)
+        conn = owner.connect()
+    elif _db_ctx.engine_name is None and replicas and not _db_ctx.pinned and not _db_ctx.primary_reads:
+        owner, conn = replicas.connect()
+    else:
+        owner = _get_engine(_db_ctx.engine_name)
+        conn = owner.connect()
+    cursor = None
+    exhausted = False
+    #只统计数据库上花的时间，不包括调用方处理每一行的时间
+    elapsed = 0.0
+    count = 0
+    try:
+        start = time.time()
+        cursor = conn.cursor(buffered=False)
+        cursor.execute(sql, args)
+        row = _row_factory(cursor.description, compact)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            elapsed += time.time() - start
+            if not rows:
+                break
+            count += len(rows)
+            for values in rows:
+                yield row(values)
+            start = time.time()
+        exhausted = True
+    finally:
+        if own and not exhausted:
+            #提前结束（或出错）时连接上还留着未读的结果集，直接关闭这个连接，不去读完剩下的行
+            owner.discard(conn)
+        else:
+            try:
+                if cursor:
+                    if not exhausted:
+                        #事务的连接不能关闭，只能读完剩下的结果
+                        while cursor.fetchmany(batch_size):
+                            pass
+                    cursor.close()
+            finally:
+                if own:
+                    owner.release(conn)
+            _record(sql, args, time.time() - elapsed, count, exhausted)
 
 @with_connection
 def _update(sql, *args):
@@ -314,20 +1406,95 @@ def _update(sql, *args):
     '''
     global _db_ctx
     cursor = None
-    sql = sql.replace('?', '%s')
-    logging.info('SQL:%s ,ARGS:%s' %(sql, args))
+    sql = compile_sql(sql)
+    logging.debug('SQL:%s ,ARGS:%s', sql, args)
+    _db_ctx.pinned = True
+    start = time.time()
+    r = 0
+    ok = False
     try:
         cursor = _db_ctx.connection.cursor()
         cursor.execute(sql, args)
         r = cursor.rowcount
+        table = _wrote(sql)
         if _db_ctx.transcations == 0:
             #no transaction enviroment
-            logging.info('auto commit')
+            logging.debug('auto commit')
+            _db_ctx.connection.commit()
+            _committed(table)
+        ok = True
+        return r
+    finally:
+        if cursor:
+            cursor.close()
+        _record(sql, args, start, r, ok)
+
+@with_connection
+def update_many(sql, args_list):
+    '''
+    用cursor.executemany对每组参数执行同一条sql，返回影响的总行数
+    '''
+    global _db_ctx
+    cursor = None
+    sql = compile_sql(sql)
+    logging.debug('SQL:%s ,ARGS:%d rows', sql, len(args_list))
+    _db_ctx.pinned = True
+    start = time.time()
+    r = 0
+    ok = False
+    try:
+        cursor = _db_ctx.connection.cursor()
+        cursor.executemany(sql, args_list)
+        r = cursor.rowcount
+        table = _wrote(sql)
+        if _db_ctx.transcations == 0:
+            logging.debug('auto commit')
             _db_ctx.connection.commit()
+            _committed(table)
+        ok = True
         return r
     finally:
         if cursor:
             cursor.close()
+        _record(sql, args_list, start, r, ok)
+
+#每张表的写入代数：每次写这张表都换一个新的代数，提交（或事务结束）后再换一次（防止别的线程在提交前把旧数据放进缓存）
+#代数取自全局递增的计数，并发的写不会得到同一个代数
+#查询结果的缓存把代数作为key的一部分，写过之后旧的缓存不会再被使用
+_generations = {}
+_generation_counter = itertools.count(1)
+_write_tables = {}
+_WRITE_TABLE = re.compile(r'^\s*(?:insert\s+(?:ignore\s+)?into|replace\s+into|update(?:\s+ignore)?|delete\s+from|truncate(?:\s+table)?|alter\s+table|drop\s+table(?:\s+if\s+exists)?)\s+`?(\w+)`?', re.I)
+
+def table_generation(table):
+    return _generations.get(table, 0)
+
+def bump_generation(table):
+    _generations[table] = next(_generation_counter)
+
+def _wrote(sql):
+    '''
+    执行写语句之后调用，返回写的表名（识别不出时为None）
+    '''
+    table = _write_tables.get(sql, _write_tables)
+    if table is _write_tables:
+        m = _WRITE_TABLE.match(sql)
+        table = m.group(1) if m else None
+        if len(_write_tables) >= 2000:
+            _write_tables.clear()
+        _write_tables[sql] = table
+    if table is not None:
+        bump_generation(table)
+        if _db_ctx.transcations > 0:
+            _db_ctx.callbacks.append(lambda committed: bump_generation(table))
+    return table
+
+def _committed(table):
+    '''
+    事务外的写语句提交之后调用：写和提交之间别的线程可能读到旧数据并放进了新一代的缓存
+    '''
+    if table is not None:
+        bump_generation(table)
 
 def insert(table, **kw):
     '''
@@ -337,9 +1504,202 @@ def insert(table, **kw):
     sql = 'insert into `%s` (%s) values (%s)' % (table, ','.join(['`%s`' % col for col in cols]), ','.join(['?' for i in range(len(cols))]))
     return _update(sql, *args)
 
+def _estimate_size(v):
+    '''
+    粗略估计一个参数在sql包中占用的字节数，unicode按utf8编码后的长度计算
+    '''
+    if isinstance(v, unicode):
+        return len(v.encode('utf-8')) + 3
+    if isinstance(v, str):
+        return len(v) + 3
+    return 24
+
+@with_connection
+def insert_many(table, rows, max_rows=1000, max_bytes=1024*1024):
+    '''
+    批量插入，rows为字典的序列，字段相同的行合并成一条
+    insert into `table` (...) values (...),(...) 语句执行
+    每条语句最多max_rows行，参数估计大小不超过max_bytes（max_allowed_packet的预算）
+    不在事务中时每条语句提交一次，返回插入的总行数
+    '''
+    return _insert_rows(table, rows, max_rows, max_bytes)
+
+def _insert_rows(table, rows, max_rows, max_bytes, suffix=None):
+    '''
+    insert_many和upsert_many的实现，suffix(cols)返回加在每条语句后面的sql
+    '''
+    groups = {}
+    order = []
+    for kw in rows:
+        cols = tuple(sorted(kw.iterkeys()))
+        if not cols in groups:
+            groups[cols] = []
+            order.append(cols)
+        groups[cols].append([kw[col] for col in cols])
+    r = 0
+    for cols in order:
+        head = 'insert into `%s` (%s) values ' % (table, ','.join(['`%s`' % col for col in cols]))
+        tail = suffix(cols) if suffix else ''
+        holder = '(%s)' % ','.join(['?' for col in cols])
+        batch, args, size = [], [], len(head) + len(tail)
+        for values in groups[cols]:
+            n = sum([_estimate_size(v) for v in values]) + len(holder) + 1
+            if batch and (len(batch) >= max_rows or size + n > max_bytes):
+                r = r + _update(head + ','.join(batch) + tail, *args)
+                batch, args, size = [], [], len(head) + len(tail)
+            batch.append(holder)
+            args.extend(values)
+            size = size + n
+        if batch:
+            r = r + _update(head + ','.join(batch) + tail, *args)
+    return r
+
+def upsert_clause(cols, keys):
+    '''
+    on duplicate key update 子句，keys以外的字段用新插入的值更新
+    '''
+    updates = [col for col in cols if not col in keys]
+    if not updates:
+        #只有键字段时什么也不改，但不能报主键冲突
+        return ' on duplicate key update `%s`=`%s`' % (cols[0], cols[0])
+    return ' on duplicate key update %s' % ','.join(['`%s`=values(`%s`)' % (col, col) for col in updates])
+
+def upsert(table, keys, **kw):
+    '''
+    insert into ... on duplicate key update ...，一条语句完成"不存在则插入，存在则更新"
+    keys是唯一键的字段，不会被更新，kw中其他字段都用新值更新
+    返回影响的行数（mysql中插入为1，更新为2，没有变化为0）
+    '''
+    cols, args = zip(*kw.iteritems())
+    sql = 'insert into `%s` (%s) values (%s)' % (table, ','.join(['`%s`' % col for col in cols]), ','.join(['?' for i in range(len(cols))]))
+    return _update(sql + upsert_clause(cols, frozenset(keys)), *args)
+
+@with_connection
+def upsert_many(table, keys, rows, max_rows=1000, max_bytes=1024*1024):
+    '''
+    批量的upsert，和insert_many一样合并成多行的语句
+    '''
+    keys = frozenset(keys)
+    return _insert_rows(table, rows, max_rows, max_bytes, lambda cols: upsert_clause(cols, keys))
+
 def update(sql, *args):
     return _update(sql, *args)
 
+#异步接口：python2没有asyncio/contextvars，驱动也是阻塞的，这里不是真正的异步IO，
+#只是把阻塞的数据库调用交给固定大小的线程池执行（有界的后台执行）：调用方立即得到一个AsyncResult，
+#可以先做别的事或者同时发出几个查询，但get()仍然阻塞当前线程直到结果返回。
+#每个在途的查询占用池中的一个线程和一个连接，同时在途的查询数由ASYNC_WORKERS和连接池的大小限制，
+#超出的调用在池中排队
+_async_workers = None
+ASYNC_WORKERS = 16
+
+def _async_pool():
+    global _async_workers
+    if _async_workers is None:
+        with _workers_lock:
+            if _async_workers is None:
+                from multiprocessing.pool import ThreadPool
+                _async_workers = ThreadPool(ASYNC_WORKERS, _init_pool_thread, ('async',))
+    return _async_workers
+
+def _call_using(name, primary, func, args, kw):
+    with using(name):
+        if not primary:
+            return func(*args, **kw)
+        with read_primary():
+            return func(*args, **kw)
+
+class _DoneResult(object):
+    '''
+    已经执行完的结果，接口和AsyncResult一样
+    '''
+    def __init__(self, func, *args):
+        try:
+            self._value, self._success = func(*args), True
+        except Exception, e:
+            self._value, self._success = e, False
+
+    def ready(self):
+        return True
+
+    def successful(self):
+        return self._success
+
+    def wait(self, timeout=None):
+        pass
+
+    def get(self, timeout=None):
+        if self._success:
+            return self._value
+        raise self._value
+
+def submit(func, *args, **kw):
+    '''
+    在异步线程池中执行func(*args, **kw)，返回AsyncResult（get(timeout)、ready()、successful()），
+    func出错时get()抛出同样的异常。get()会阻塞调用的线程，见上面的说明
+    调用方用using()选择的engine会带到执行的线程中，但连接和事务不会，每次调用单独借连接
+    调用方的读走主库时（在事务中、写过之后的connection()中或者read_primary()中），执行的线程也读主库
+    在异步线程池的线程中调用时（比如submit的函数里又调用了gather），直接在当前线程执行，返回已完成的结果
+    '''
+    primary = _db_ctx.primary_reads > 0 or (_db_ctx.is_init() and (_db_ctx.transcations > 0 or _db_ctx.pinned))
+    if _pool_thread.pool == 'async':
+        return _DoneResult(_call_using, _db_ctx.engine_name, primary, func, args, kw)
+    return _async_pool().apply_async(_call_using, (_db_ctx.engine_name, primary, func, args, kw))
+
+def aselect(sql, *args, **kw):
+    return submit(select, sql, *args, **kw)
+
+def aselect_one(sql, *args, **kw):
+    return submit(select_one, sql, *args, **kw)
+
+def aselect_int(sql, *args):
+    return submit(select_int, sql, *args)
+
+def aupdate(sql, *args):
+    return submit(update, sql, *args)
+
+def _gather_call(query):
+    if isinstance(query, basestring):
+        return select(query)
+    if callable(query):
+        return query()
+    func, args = query[0], query[1:]
+    if isinstance(func, basestring):
+        return select(func, *args)
+    return func(*args)
+
+def gather(*queries, **kw):
+    '''
+    并行执行多个互相独立的查询，每个查询单独从连接池借连接，按传入的顺序返回结果列表
+    每个查询可以是：
+        sql字符串或(sql, arg1, ...)  --> select(sql, *args)
+        (func, arg1, ...)或func        --> func(*args)，比如(select_int, sql, arg)、(Blog.get, blog_id)
+    例如
+        blog, count, user = db.gather((Blog.get, blog_id),
+                                      (db.select_int, 'select count(*) from comments where blog_id=?', blog_id),
+                                      (User.get, user_id))
+    任何一个查询出错时，等所有查询结束后按顺序抛出第一个异常。可选参数timeout为等待每个结果的秒数
+    查询不在当前的事务中执行，看不到当前事务中未提交的数据；在submit()执行的函数中调用时，查询依次执行
+    '''
+    timeout = kw.pop('timeout', None)
+    results = [submit(_gather_call, q) for q in queries]
+    for r in results:
+        r.wait(timeout)
+    return [r.get(0 if timeout is not None else None) for r in results]
+
+def _call_in_transaction(func, *args, **kw):
+    with transaction():
+        return func(*args, **kw)
+
+def atransaction(func, *args, **kw):
+    '''
+    在异步线程池的一个线程中开启事务执行func(*args, **kw)，事务中的所有语句使用同一个连接，
+    正常返回时提交，出错时回滚，返回AsyncResult，例如
+        r = db.atransaction(transfer, from_id, to_id, amount)
+        r.get()
+    '''
+    return submit(_call_in_transaction, func, *args, **kw)
+
 
 
 # if __name__ == '__main__':
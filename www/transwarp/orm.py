@@ -32,11 +32,54 @@ from transwarp import db
         最后id，name变成了类的属性
 '''
 
+import re
+import sys
 import time
+import operator
+import json
+import base64
 import logging
+import threading
+import itertools
+from collections import OrderedDict
 
 _triggers = frozenset(['pre_insert', 'pre_update', 'pre_delete'])
 
+#类名 --> Model子类，用于解析Field的references
+_models = {}
+
+_MISSING = object()
+
+#计数器表，模型声明__counters__之前先用COUNTERS_DDL建表，分片时每个分片都要建
+COUNTERS_TABLE = 'orm_counters'
+COUNTERS_DDL = '''create table `orm_counters` (
+    `tbl` varchar(64) not null,
+    `col` varchar(64) not null,
+    `val` varchar(255) not null,
+    `n` bigint not null,
+    primary key (`tbl`, `col`, `val`)
+)'''
+_COUNTER_BUMP_SQL = db.compile_sql('insert into `%s` (`tbl`,`col`,`val`,`n`) values (?,?,?,?) on duplicate key update `n`=`n`+values(`n`)' % COUNTERS_TABLE)
+_COUNTER_INSERT_SQL = db.compile_sql('insert into `%s` (`tbl`,`col`,`val`,`n`) values (?,?,?,?)' % COUNTERS_TABLE)
+_COUNTER_SELECT_SQL = db.compile_sql('select `n` from `%s` where `tbl`=? and `col`=? and `val`=?' % COUNTERS_TABLE)
+#count_by中可以直接读计数器的条件：where field=?
+_COUNT_WHERE = re.compile(r'^\s*where\s+`?(\w+)`?\s*=\s*\?\s*$', re.I)
+
+def _counter_value(v):
+    return '' if v is None else unicode(v)
+
+class _NullScope(object):
+    '''
+    什么都不做的上下文，比如不分片的Model写操作，沿用当前的engine
+    '''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, trace):
+        pass
+
+_NO_SCOPE = _NullScope()
+
 #`%s`
 # '--generating SQL for %s:' % table_name,
 def _gen_sql(table_name, mappings):
@@ -58,6 +101,17 @@ def _gen_sql(table_name, mappings):
     #return '\n'.join(sql)
     return ''.join(sql)
 
+def _resolve_model(model):
+    '''
+    references可以是Model子类，也可以是类名（被引用的类可以定义在后面）
+    '''
+    if isinstance(model, basestring):
+        try:
+            return _models[model]
+        except KeyError:
+            raise TypeError('Unknown model referenced: %s' % model)
+    return model
+
 class Field(object):
     '''
     保存数据库中的表的 字段属性,在web模块中这个ORM模块是一个独立的模块
@@ -72,6 +126,11 @@ class Field(object):
         self.updatable = kw.get('updatable', True)
         self.insertable = kw.get('insertable', True)
         self.ddl = kw.get('ddl', '')
+        #references: 该字段引用的Model（类或者类名），relation: 关联对象的属性名，缺省为去掉_id后缀的字段名
+        self.references = kw.get('references', None)
+        self.relation = kw.get('relation', None)
+        #deferred: 查询时不加载这个字段，第一次访问时再加载，用于大的text/blob字段
+        self.deferred = kw.get('deferred', False)
         self._order = Field._count
         Field._count += 1
 
@@ -144,7 +203,7 @@ class TextField(Field):
         if not 'default' in kw:
             kw['default'] = ''
         if not 'ddl' in kw:
-            kw['default'] = 'text'
+            kw['ddl'] = 'text'
         super(TextField, self).__init__(**kw)
 
 class BlobField(Field):
@@ -166,6 +225,279 @@ class VersionField(Field):
     def __init__(self, name=None):
         super(VersionField, self).__init__(name=name, defualt=0, ddl='bigint')
 
+class _LRUCache(object):
+    '''
+    进程内的LRU缓存，最多保存size个条目，每个条目ttl秒后过期（ttl<=0表示不过期）
+    线程安全，记录命中和未命中的次数
+    '''
+    def __init__(self, size=1000, ttl=60):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None or (self.ttl > 0 and item[1] < time.time()):
+                self.misses += 1
+                return None
+            self._data[key] = item #移到最后，表示最近使用过
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, time.time() + self.ttl)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+#查询结果缓存，缺省关闭，见enable_query_cache
+query_cache = None
+
+def enable_query_cache(size=1000, ttl=60, backend=None):
+    '''
+    开启find_first/find_by/find_all/count_by/Query的结果缓存，key为(模型, 归一化的sql, 参数, 表的写入代数)，
+    写过这张表之后旧的结果不再使用（见db.table_generation），事务中的查询不使用缓存
+    backend缺省为进程内的_LRUCache(size, ttl)，也可以传入实现了get(key)/put(key, value)/clear()的对象（缓存的值都可以pickle）；
+    写入代数只在本进程内，共享的backend要靠ttl限制其他进程写入后的过期时间
+    只跟踪模型自己的表，where中子查询了其他表的查询可以把模型的__query_cache__设为False
+    '''
+    global query_cache
+    query_cache = backend if backend is not None else _LRUCache(size, ttl)
+
+def disable_query_cache():
+    global query_cache
+    query_cache = None
+
+def _encode_cursor(inst, key, pk):
+    '''
+    把(key, 主键)编码成不透明的分页游标
+    '''
+    return base64.urlsafe_b64encode(json.dumps([getattr(inst, key), getattr(inst, pk)]))
+
+def _decode_cursor(cursor):
+    try:
+        value, pk = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        raise ValueError('Bad page cursor: %r' % cursor)
+    return value, pk
+
+class Query(object):
+    '''
+    惰性的链式查询，由Model.query()创建，例如
+        Blog.query().where('user_id=?', uid).order_by('-create_at').limit(20)
+    where/order_by/limit/offset/prefetch都返回新的Query，只有遍历、len、切片、count()时才执行sql
+    编译好的sql文本缓存在Query对象上，遍历的结果也只查询一次
+    '''
+    def __init__(self, model):
+        self._model = model
+        self._where = []
+        self._args = []
+        self._order = []
+        self._limit = None
+        self._offset = None
+        self._prefetch = ()
+        self._shard = None
+        self._fields = None
+        self._sql = None
+        self._result = None
+
+    def _clone(self, **kw):
+        q = Query(self._model)
+        q._where = list(self._where)
+        q._args = list(self._args)
+        q._order = list(self._order)
+        q._limit = self._limit
+        q._offset = self._offset
+        q._prefetch = self._prefetch
+        q._shard = self._shard
+        q._fields = self._fields
+        for k, v in kw.iteritems():
+            setattr(q, '_' + k, v)
+        return q
+
+    def where(self, clause, *args):
+        '''
+        增加一个条件，多个条件之间是and的关系
+        '''
+        q = self._clone()
+        q._where.append(clause)
+        q._args.extend(args)
+        return q
+
+    def order_by(self, *fields):
+        '''
+        按字段排序，字段名前加'-'表示降序
+        '''
+        order = list(self._order)
+        for f in fields:
+            name = f[1:] if f.startswith('-') else f
+            if not name in self._model.__mappings__:
+                raise AttributeError('%s has no field named %s' % (self._model.__name__, name))
+            order.append((name, f.startswith('-')))
+        return self._clone(order=order)
+
+    def limit(self, n):
+        return self._clone(limit=int(n))
+
+    def offset(self, n):
+        return self._clone(offset=int(n))
+
+    def prefetch(self, *relations):
+        return self._clone(prefetch=self._prefetch + relations)
+
+    def only(self, *fields):
+        '''
+        只加载这些字段（以及主键和排序的字段），见Model.find_by的fields
+        '''
+        return self._clone(fields=fields)
+
+    def shard(self, key):
+        '''
+        只查询分片键为key的数据所在的分片，分片的Model没有指定时查询所有分片再合并
+        '''
+        return self._clone(shard=key)
+
+    def seek(self, cursor=None, limit=20, backward=False, key='create_at', desc=True):
+        '''
+        keyset分页：按(key, 主键)排序，用上一页最后一行的(key, 主键)作为条件取下一页，
+        不使用offset，翻到多深代价都一样
+        cursor是上一次seek返回的next或prev，None表示第一页；backward=True表示往回翻
+        desc=True时按key降序（新的在前），返回 Dict(rows=[...], next=游标或None, prev=游标或None)
+        '''
+        if self._order or self._limit is not None or self._offset:
+            raise ValueError('seek() cannot be combined with order_by/limit/offset')
+        model = self._model
+        pk = model.__primary_key__.name
+        if not key in model.__mappings__:
+            raise AttributeError('%s has no field named %s' % (model.__name__, key))
+        #往后翻时和排序方向一致，往回翻时反过来取，再倒序
+        forward_desc = desc != backward
+        q = self
+        if cursor is not None:
+            value, last = _decode_cursor(cursor)
+            op = '<' if forward_desc else '>'
+            q = q.where('`%s`%s? or (`%s`=? and `%s`%s?)' % (key, op, key, pk, op), value, value, last)
+        sign = '-' if forward_desc else ''
+        L = q.order_by(sign + key, sign + pk).limit(limit + 1).all()
+        more = len(L) > limit
+        L = L[:limit]
+        if backward:
+            L.reverse()
+        page = db.Dict(rows=L, next=None, prev=None)
+        if L:
+            first, end = _encode_cursor(L[0], key, pk), _encode_cursor(L[-1], key, pk)
+            if backward:
+                page.next = end
+                page.prev = first if more else None
+            else:
+                page.next = end if more else None
+                page.prev = first if cursor is not None else None
+        return page
+
+    def _where_sql(self):
+        if not self._where:
+            return ''
+        return 'where %s' % ' and '.join(['(%s)' % w for w in self._where])
+
+    def sql(self):
+        '''
+        返回编译好的sql文本，只生成一次
+        '''
+        if self._sql is None:
+            fields = self._fields
+            if fields is not None:
+                fields = list(fields) + [name for name, desc in self._order]
+            L = ['select %s from `%s`' % (self._model._columns(fields), self._model.__table__)]
+            where = self._where_sql()
+            if where:
+                L.append(where)
+            if self._order:
+                L.append('order by %s' % ','.join(['`%s`%s' % (name, ' desc' if desc else '') for name, desc in self._order]))
+            if self._limit is not None:
+                L.append('limit %d' % self._limit)
+            if self._offset:
+                if self._limit is None:
+                    L.append('limit 18446744073709551615') #mysql的offset必须和limit一起使用
+                L.append('offset %d' % self._offset)
+            self._sql = ' '.join(L)
+        return self._sql
+
+    def all(self):
+        if self._result is None:
+            cls = self._model
+            if cls._shard_router() is None or self._shard is not None:
+                load = lambda: cls._select(self._shard, self.sql(), *self._args)
+            else:
+                load = self._merge_shards
+            L = cls._cached('all', self._shard, self.sql(), tuple(self._args), load)
+            self._result = cls.prefetch([cls._load(d) for d in L], *self._prefetch)
+        return self._result
+
+    def _merge_shards(self):
+        '''
+        在所有分片上并行查询，每个分片取前offset+limit行，合并后重新排序再截取
+        '''
+        start = self._offset or 0
+        q = self._clone(offset=None, limit=None if self._limit is None else start + self._limit)
+        L = self._model._select(None, q.sql(), *self._args)
+        for name, desc in reversed(self._order):
+            L.sort(key=operator.itemgetter(name), reverse=desc)
+        return L[start:] if self._limit is None else L[start:start+self._limit]
+
+    def first(self):
+        L = self.limit(1).all() if self._result is None else self._result
+        return L[0] if L else None
+
+    def count(self):
+        '''
+        执行count_by，不受limit/offset的影响
+        '''
+        return self._model.count_by(self._where_sql(), *self._args, shard=self._shard)
+
+    def __iter__(self):
+        return iter(self.all())
+
+    def __len__(self):
+        return len(self.all())
+
+    def __getitem__(self, index):
+        if self._result is not None:
+            return self._result[index]
+        if isinstance(index, slice):
+            if index.step not in (None, 1) or (index.start or 0) < 0 or (index.stop is not None and index.stop < 0):
+                return self.all()[index]
+            start = index.start or 0
+            base = self._offset or 0
+            q = self._clone(offset=base + start)
+            if index.stop is not None:
+                n = max(0, index.stop - start)
+                q._limit = n if self._limit is None else max(0, min(n, self._limit - start))
+            elif self._limit is not None:
+                q._limit = max(0, self._limit - start)
+            return q.all()
+        if index < 0:
+            return self.all()[index]
+        L = self[index:index+1]
+        if not L:
+            raise IndexError('query index out of range')
+        return L[0]
+
 class ModelMetalclass(type):
     '''
     对类对象动态完成以下操作
@@ -181,8 +513,8 @@ class ModelMetalclass(type):
     '''
 
     def __new__(cls, name, bases, attrs):
-        #跳过基类Model
-        if name == 'Model':
+        #跳过基类Model、_Record
+        if name in ('Model', '_Record'):
             return type.__new__(cls, name, bases, attrs)
 
         #保存所有子类的信息
@@ -193,14 +525,14 @@ class ModelMetalclass(type):
         else:
             logging.warning('Redefine class:%s' %name)
 
-        logging.info('Scan OQMapping %s ...' %name)
+        logging.debug('Scan OQMapping %s ...', name)
         mappings = dict()
         primary_key = None
         for k, v in attrs.iteritems():
             if isinstance(v, Field):
                 if not v.name:
                     v.name = k
-                logging.info('[MAPPING] Found mapping: %s => %s' % (k, v))
+                logging.debug('[MAPPING] Found mapping: %s => %s', k, v)
 
                 #检查重复的主键
                 if v.primary_key:
@@ -218,17 +550,78 @@ class ModelMetalclass(type):
         #检查已经存在的主键
         if not primary_key:
             raise TypeError('primary not define in class %s' % name)
+
+        #关联关系：relation名 --> 引用其他Model的字段
+        relations = dict()
+        for k, v in mappings.iteritems():
+            if v.references:
+                if not v.relation:
+                    if not k.endswith('_id'):
+                        raise TypeError('Field %s in class %s references %s but has no relation name' % (k, name, v.references))
+                    v.relation = k[:-3]
+                relations[v.relation] = v
         for k in mappings.iterkeys():
             attrs.pop(k)
         if not '__table__' in attrs:
             attrs['__table__'] = name.lower()
         attrs['__mappings__'] = mappings
         attrs['__primary_key__'] = primary_key
+        attrs['__relations__'] = relations
         attrs['__sql__'] = lambda self: _gen_sql(attrs['__table__'], mappings)
+
+        #预先生成CRUD的字段顺序和sql，调用时只需要收集参数
+        table = attrs['__table__']
+        pk = primary_key.name
+        fields = sorted(mappings.iteritems(), key=lambda kv: kv[1]._order)
+        inserts = tuple([(k, v) for k, v in fields if v.insertable])
+        updates = tuple([(k, v) for k, v in fields if v.updatable])
+        attrs['__fields__'] = tuple([k for k, v in fields])
+        deferred = tuple([k for k, v in fields if v.deferred])
+        if primary_key.deferred or (attrs.get('__shard_key__') in deferred):
+            raise TypeError('Primary key and shard key of class %s can not be deferred' % name)
+        attrs['__deferred__'] = deferred
+        attrs['__columns__'] = ','.join(['`%s`' % v.name for k, v in fields if not v.deferred]) if deferred else '*'
+        attrs['__insert_fields__'] = inserts
+        attrs['__update_fields__'] = updates
+        attrs['__select_sql__'] = db.compile_sql('select %s from `%s` where `%s`=?' % (attrs['__columns__'], table, pk))
+        insert_sql = 'insert into `%s` (%s) values (%s)' % (table, ','.join(['`%s`' % v.name for k, v in inserts]), ','.join(['?'] * len(inserts)))
+        attrs['__insert_sql__'] = db.compile_sql(insert_sql)
+        attrs['__update_sql__'] = db.compile_sql('update `%s` set %s where `%s`=?' % (table, ','.join(['`%s`=?' % v.name for k, v in updates]), pk)) if updates else None
+        attrs['__delete_sql__'] = db.compile_sql('delete from `%s` where `%s`=?' % (table, pk))
+        attrs['__upsert_keys__'] = frozenset([v.name for k, v in inserts if not v.updatable])
+        attrs['__upsert_sql__'] = db.compile_sql(insert_sql + db.upsert_clause([v.name for k, v in inserts], attrs['__upsert_keys__']))
+        attrs['__partial_update_sql__'] = {}
+
+        #__shard_key__ 按这个字段分片，__shard_router__ 为空时使用db.shard_router
+        shard_key = attrs.get('__shard_key__')
+        if shard_key is not None and not shard_key in mappings:
+            raise TypeError('Shard key %s is not a field of class %s' % (shard_key, name))
+        router = attrs.get('__shard_router__')
+        attrs['__shard_key__'] = shard_key
+        attrs['__shard_router__'] = db.ShardRouter(router) if router is not None and not isinstance(router, db.ShardRouter) else router
+        #__counters__ 需要维护计数的分组字段，'*'表示整张表的行数
+        counters = tuple(attrs.get('__counters__', ()))
+        for k in counters:
+            if k != '*' and not k in mappings:
+                raise TypeError('Counter %s is not a field of class %s' % (k, name))
+        attrs['__counters__'] = counters
+        attrs.setdefault('__query_cache__', True)
+        #__cache_size__ 开启按主键的进程内LRU缓存，__cache_ttl__ 为缓存的过期秒数
+        size = attrs.get('__cache_size__', 0)
+        attrs['__cache__'] = _LRUCache(size, attrs.get('__cache_ttl__', 60)) if size else None
+        attrs['__identity_hits__'] = 0
         for trigger in _triggers:
             if not trigger in attrs:
                 attrs[trigger] =None
-        return type.__new__(cls, name, bases, attrs)
+        #__compact__ = True 时用_Record代替dict保存字段，见_Record
+        if attrs.get('__compact__'):
+            if not Model in bases:
+                raise TypeError('Compact class %s must subclass Model directly' % name)
+            bases = tuple([_Record if b is Model else b for b in bases])
+            attrs['__slots__'] = tuple(mappings) + tuple(relations)
+        model = type.__new__(cls, name, bases, attrs)
+        _models[name] = model
+        return model
 
 class Model(dict):
     '''
@@ -237,7 +630,16 @@ class Model(dict):
         "__table__":表名
         "__mappings__":字段对象（所有的字段属性，见Field类）
         "__primary_key__":主键字段
+        "__relations__":关联关系，relation名 --> 带有references的字段
+        "__fields__"/"__insert_fields__"/"__update_fields__":按定义顺序排好的字段
+        "__deferred__"/"__columns__":延迟加载的字段，以及缺省查询的字段列表（没有延迟加载的字段时为*）
+        "__select_sql__"/"__insert_sql__"/"__update_sql__"/"__delete_sql__"/"__upsert_sql__":预先生成的CRUD语句
         "__sql__":创建sql表时执行
+        "__cache__":按主键的LRU缓存，子类定义__cache_size__/__cache_ttl__时开启
+        "__shard_key__"/"__shard_router__":分片键和分片路由，没有定义时不分片
+        "__compact__":为True时实例用__slots__保存字段，不再是dict，见_Record
+        "__counters__":按字段分组的行数计数器，例如 ('*', 'blog_id')，见count_of
+        "__query_cache__":为False时不使用查询结果缓存，见enable_query_cache
 
 
     >>> class User(Model):
@@ -289,98 +691,1335 @@ class Model(dict):
     def __init__(self, **kw):
         super(Model, self).__init__(**kw)
 
+    #从数据库加载或者保存过的实例，记录被修改字段的原始值 {字段: 原始值}，新建的实例为None
+    _changed = None
+
+    @classmethod
+    def _load(cls, d):
+        '''
+        用查询结果生成实例，并开始记录字段的修改
+        '''
+        inst = cls(**d)
+        inst._reset_changes()
+        return inst
+
+    def _reset_changes(self):
+        object.__setattr__(self, '_changed', {})
+
+    def _set_loaded(self, key, value):
+        '''
+        保存从数据库补充加载的字段，不记录为修改
+        '''
+        dict.__setitem__(self, key, value)
+
+    def _unload(self, key):
+        '''
+        丢掉已经过时的字段值，下次访问时重新加载
+        '''
+        dict.pop(self, key, None)
+
+    def __setattr__(self, key, value):
+        if key in self.__mappings__:
+            self[key] = value
+        else:
+            object.__setattr__(self, key, value)
+
+    def __setitem__(self, key, value):
+        if self._changed is not None and key in self.__mappings__:
+            self._track(key, dict.get(self, key, _MISSING), value)
+        dict.__setitem__(self, key, value)
+
+    def _track(self, key, old, value):
+        changed = self._changed
+        if key in changed:
+            if changed[key] == value:
+                del changed[key] #改回了原始值
+        elif old is _MISSING or old != value:
+            changed[key] = old
+
+    def dirty_fields(self):
+        '''
+        返回加载之后被修改过的字段名，新建的实例返回None
+        '''
+        changed = self._changed
+        return None if changed is None else changed.keys()
+
     def __getattr__(self, key):
         try:
             return self[key]
         except KeyError:
+            pass
+        if self._changed is not None and key in self.__mappings__:
+            self._load_missing(key)
+            return self[key]
+        field = getattr(self.__class__, '__relations__', {}).get(key)
+        if field is None:
             raise AttributeError(r"'Dict' object has no attribute '%s" %  key)
+        #没有预先加载的关联对象，访问时再按主键加载一次
+        fk = getattr(self, field.name, None)
+        target = _resolve_model(field.references).get(fk) if fk else None
+        object.__setattr__(self, key, target)
+        return target
+
+    def _has(self, key):
+        '''
+        字段是否已经有值，不会触发延迟加载（hasattr和_Record的in会经过__getattr__）
+        '''
+        return dict.__contains__(self, key)
+
+    def _load_missing(self, key):
+        '''
+        从数据库加载的实例访问还没有加载的字段时再查询一次：
+        延迟加载的字段单独加载，投影时没有选择的其他字段一起加载
+        '''
+        cls = self.__class__
+        if key in cls.__deferred__:
+            names = [key]
+        else:
+            names = [k for k in cls.__fields__ if not k in cls.__deferred__ and not self._has(k)]
+        pk = cls.__primary_key__.name
+        with self._scope():
+            d = db.select_one('select %s from `%s` where `%s`=?' % (cls._columns(names, False), cls.__table__, pk), getattr(self, pk), compact=True)
+        if d is None:
+            raise AttributeError('%s(%s) no longer exists, can not load %s' % (cls.__name__, getattr(self, pk), key))
+        for k in names:
+            self._set_loaded(k, d[cls.__mappings__[k].name])
+
+    @classmethod
+    def _columns(cls, fields=None, keys=True):
+        '''
+        select的字段列表，fields为None时是缺省的__columns__，
+        否则是fields中的字段，keys为True时再加上主键和分片键（加载其他字段时需要）
+        '''
+        if fields is None:
+            return cls.__columns__
+        names = [cls.__primary_key__.name, cls.__shard_key__] if keys else []
+        for f in fields:
+            if not f in cls.__mappings__:
+                raise AttributeError('%s has no field named %s' % (cls.__name__, f))
+            names.append(f)
+        seen = set()
+        L = []
+        for k in names:
+            if k is not None and not k in seen:
+                seen.add(k)
+                L.append('`%s`' % cls.__mappings__[k].name)
+        return ','.join(L)
+
+    @classmethod
+    def undefer(cls, instances, *fields):
+        '''
+        批量加载instances中还没有加载的字段，每500个主键一条 where pk in (...)，
+        fields缺省为所有延迟加载的字段，例如
+            blogs = Blog.find_all()
+            Blog.undefer(blogs, 'content')
+        '''
+        fields = fields or cls.__deferred__
+        pk = cls.__primary_key__.name
+        todo = {}
+        for inst in instances:
+            if [f for f in fields if not inst._has(f)]:
+                todo.setdefault(getattr(inst, pk), []).append(inst)
+        pks = todo.keys()
+        columns = cls._columns(fields)
+        for i in range(0, len(pks), 500):
+            chunk = pks[i:i+500]
+            for d in cls._select(None, 'select %s from `%s` where `%s` in (%s)' % (columns, cls.__table__, pk, ','.join(['?'] * len(chunk))), *chunk):
+                for inst in todo.get(d[pk], ()):
+                    for f in fields:
+                        if not inst._has(f):
+                            inst._set_loaded(f, d[cls.__mappings__[f].name])
+        return instances
+
+    @classmethod
+    def prefetch(cls, instances, *relations):
+        '''
+        批量加载instances的关联对象，每个relation只执行一次get_many（分批的 where pk in (...)）
+        加载结果作为属性挂到实例上，例如 comment.user
+        '''
+        for relation in relations:
+            field = cls.__relations__.get(relation)
+            if field is None:
+                raise AttributeError('%s has no relation named %s' % (cls.__name__, relation))
+            keys = [getattr(inst, field.name, None) for inst in instances]
+            targets = _resolve_model(field.references).get_many([k for k in keys if k])
+            found = dict(zip([k for k in keys if k], targets))
+            for inst, k in zip(instances, keys):
+                object.__setattr__(inst, relation, found.get(k) if k else None)
+        return instances
+
+    @classmethod
+    def _shard_router(cls):
+        '''
+        没有声明__shard_key__，或者没有设置分片路由时返回None，所有数据都在当前的engine上
+        '''
+        if cls.__shard_key__ is None:
+            return None
+        return cls.__shard_router__ or db.shard_router
+
+    @classmethod
+    def _on_shards(cls, func, shard=None):
+        '''
+        非分片的Model直接执行func()；分片的Model在分片键shard所在的分片上执行，
+        shard为None时在所有分片上并行执行。返回结果的列表
+        '''
+        router = cls._shard_router()
+        if router is None:
+            return [func()]
+        if shard is not None:
+            with db.using(router.shard_for(shard)):
+                return [func()]
+        return db.on_shards(func, router.names)
+
+    @classmethod
+    def _select(cls, shard, sql, *args):
+        return list(itertools.chain.from_iterable(cls._on_shards(lambda: db.select(sql, *args, compact=True), shard)))
+
+    @classmethod
+    def _select_one(cls, shard, sql, *args):
+        for d in cls._on_shards(lambda: db.select_one(sql, *args, compact=True), shard):
+            if d:
+                return d
+        return None
+
+    @classmethod
+    def _update_on_shards(cls, shard, sql, *args):
+        return sum(cls._on_shards(lambda: db.update(sql, *args), shard))
+
+    def _scope(self):
+        '''
+        写操作所在分片的上下文，非分片的Model使用当前的engine
+        '''
+        router = self._shard_router()
+        if router is None:
+            return _NO_SCOPE
+        return db.using(router.shard_for(getattr(self, self.__shard_key__)))
+
+    @classmethod
+    def _group_by_shard(cls, items, instance=None):
+        '''
+        把items按实例所在的分片分组，返回[(上下文, [item])]，instance从item中取出实例
+        '''
+        router = cls._shard_router()
+        if router is None:
+            return [(_NO_SCOPE, items)]
+        groups = OrderedDict()
+        for item in items:
+            inst = item if instance is None else instance(item)
+            groups.setdefault(router.shard_for(getattr(inst, cls.__shard_key__)), []).append(item)
+        return [(db.using(name), L) for name, L in groups.iteritems()]
+
+    @classmethod
+    def _counting(cls):
+        '''
+        有计数器的Model，写操作和计数器的修改放在同一个事务中
+        '''
+        return db.transaction() if cls.__counters__ else _NO_SCOPE
+
+    @classmethod
+    def _count_deltas(cls, instances, sign, deltas=None):
+        '''
+        累加instances对每个计数器的增减：{(字段, 值): 增减}
+        '''
+        if deltas is None:
+            deltas = {}
+        for inst in instances:
+            for f in cls.__counters__:
+                key = (f, '' if f == '*' else _counter_value(getattr(inst, f)))
+                deltas[key] = deltas.get(key, 0) + sign
+        return deltas
+
+    @classmethod
+    def _bump(cls, deltas):
+        rows = [(cls.__table__, f, v, n) for (f, v), n in deltas.iteritems() if n]
+        if rows:
+            db.update_many(_COUNTER_BUMP_SQL, rows)
+
+    @classmethod
+    def _grouped_counts(cls, where, *args):
+        '''
+        删除或修改之前统计满足where的行在每个计数器中的分布，返回{(字段, 值): 行数}
+        '''
+        deltas = {}
+        for f in cls.__counters__:
+            if f == '*':
+                deltas[(f, '')] = db.select_int('select count(*) from `%s` %s' % (cls.__table__, where), *args)
+                continue
+            column = cls.__mappings__[f].name
+            for d in db.select('select `%s`, count(*) from `%s` %s group by `%s`' % (column, cls.__table__, where, column), *args, compact=True):
+                deltas[(f, _counter_value(d[0]))] = d[1]
+        return deltas
 
     @classmethod
-    def get(cls, pk):
+    def _cached(cls, kind, shard, sql, args, load):
+        '''
+        查询结果缓存：命中时直接返回，否则在主库上执行load()并保存。缓存的是Row（不可修改），
+        每次命中都重新生成实例，调用方修改实例不会影响缓存
+        '''
+        cache = query_cache
+        if cache is None or not cls.__query_cache__ or db.in_transaction():
+            return load()
+        key = (cls.__name__, kind, db.current_engine(), shard, db.table_generation(cls.__table__), ' '.join(sql.split()), args)
+        try:
+            hash(key)
+        except TypeError:
+            return load()
+        item = cache.get(key)
+        if item is None:
+            #从副本读可能把写之前的数据放进新一代的缓存
+            with db.read_primary():
+                item = (load(),)
+            cache.put(key, item)
+        return item[0]
+
+    @classmethod
+    def count_of(cls, field, value=None, shard=None):
+        '''
+        直接读计数器，不扫描表，例如 Comment.count_of('blog_id', blog.id)
+        field为'*'时是整张表的行数；分组字段是分片键时只读value所在的分片
+        '''
+        if not field in cls.__counters__:
+            raise AttributeError('%s has no counter on %s' % (cls.__name__, field))
+        if shard is None and field == cls.__shard_key__:
+            shard = value
+        key = '' if field == '*' else _counter_value(value)
+        def read():
+            d = db.select_one(_COUNTER_SELECT_SQL, cls.__table__, field, key, compact=True)
+            return d[0] if d else 0
+        return sum(cls._on_shards(read, shard))
+
+    @classmethod
+    def rebuild_counters(cls):
+        '''
+        按表中的数据重新生成计数器，修正直接用sql修改表等原因造成的偏差，返回计数器的条数
+        '''
+        def rebuild():
+            with db.transaction():
+                db.update('delete from `%s` where `tbl`=?' % COUNTERS_TABLE, cls.__table__)
+                rows = [(cls.__table__, f, v, n) for (f, v), n in cls._grouped_counts('').iteritems()]
+                if rows:
+                    db.update_many(_COUNTER_INSERT_SQL, rows)
+            return len(rows)
+        return sum(cls._on_shards(rebuild))
+
+    @classmethod
+    def get(cls, pk, shard=None, fields=None):
         '''
         获得数据通过主键 get by primary key
+        先查当前connection()/transaction()上下文中的identity map，再查LRU缓存，最后才查数据库
+        分片的Model可以用shard传入分片键的值，否则（分片键就是主键时除外）在所有分片上查找
+        fields为只需要加载的字段（投影），其他字段在访问时再加载
+        '''
+        imap = db.identity_map()
+        if imap is not None:
+            inst = imap.get((cls, pk))
+            if inst is not None:
+                cls.__identity_hits__ += 1
+                return inst
+        cache = cls.__cache__
+        d = cache.get(pk) if cache is not None else None
+        if d is None:
+            if shard is None and cls.__shard_key__ == cls.__primary_key__.name:
+                shard = pk
+            sql = cls.__select_sql__ if fields is None else 'select %s from `%s` where `%s`=?' % (cls._columns(fields), cls.__table__, cls.__primary_key__.name)
+            #事务中可能读到未提交的数据，不放进进程级的缓存，投影的结果也不放进缓存
+            cacheable = cache is not None and fields is None and not db.in_transaction()
+            #要放进缓存的结果从主库读，见_cached
+            with db.read_primary() if cacheable else _NO_SCOPE:
+                d = cls._select_one(shard, sql, pk)
+            if d and cacheable:
+                cache.put(pk, d)
+        if not d:
+            return None
+        inst = cls._load(d)
+        if imap is not None:
+            imap[(cls, pk)] = inst
+        return inst
+
+    @classmethod
+    def get_many(cls, pks, chunk_size=500):
+        '''
+        批量按主键获取，去掉重复的主键后用 where pk in (...) 分批查询，每批最多chunk_size个
+        和get一样先查identity map和LRU缓存，结果按pks的顺序返回，不存在的主键对应None
+        '''
+        imap = db.identity_map()
+        cache = cls.__cache__
+        found = {}
+        missing = []
+        seen = set()
+        for pk in pks:
+            if pk in seen:
+                continue
+            seen.add(pk)
+            inst = imap.get((cls, pk)) if imap is not None else None
+            if inst is not None:
+                cls.__identity_hits__ += 1
+                found[pk] = inst
+                continue
+            d = cache.get(pk) if cache is not None else None
+            if d is not None:
+                found[pk] = cls._load(d)
+            else:
+                missing.append(pk)
+        pk_name = cls.__primary_key__.name
+        cacheable = cache is not None and not db.in_transaction()
+        for i in range(0, len(missing), chunk_size):
+            chunk = missing[i:i+chunk_size]
+            with db.read_primary() if cacheable else _NO_SCOPE:
+                L = cls._select(None, 'select %s from `%s` where `%s` in (%s)' % (cls.__columns__, cls.__table__, pk_name, ','.join(['?'] * len(chunk))), *chunk)
+            for d in L:
+                pk = d[pk_name]
+                if cacheable:
+                    cache.put(pk, d)
+                found[pk] = cls._load(d)
+        if imap is not None:
+            for pk, inst in found.iteritems():
+                imap[(cls, pk)] = inst
+        return [found.get(pk) for pk in pks]
+
+    @classmethod
+    def cache_stats(cls):
         '''
-        d = db.select_one('select * from %s where %s=?' % (cls.__table__, cls.__primary_key__.name), pk)
-        return cls(**d) if d else None
+        返回主键缓存的统计：identity map命中次数，LRU缓存的命中、未命中次数和条目数
+        '''
+        cache = cls.__cache__
+        if cache is None:
+            return db.Dict(identity_hits=cls.__identity_hits__, hits=0, misses=0, size=0)
+        return db.Dict(identity_hits=cls.__identity_hits__, hits=cache.hits, misses=cache.misses, size=len(cache))
+
+    def _invalidate(self, deleted=False):
+        '''
+        写操作后让缓存失效，identity map中换成当前实例，删除时移除
+        事务结束时再失效一次，避免事务期间别的线程把旧数据放回缓存
+        '''
+        cls = self.__class__
+        pk = getattr(self, cls.__primary_key__.name)
+        imap = db.identity_map()
+        if imap is not None:
+            if deleted:
+                imap.pop((cls, pk), None)
+            else:
+                imap[(cls, pk)] = self
+        cache = cls.__cache__
+        if cache is not None:
+            cache.invalidate(pk)
+            db.after_transaction(lambda committed: cache.invalidate(pk))
 
     @classmethod
-    def find_first(cls, where, *args):
+    def query(cls):
+        '''
+        返回一个惰性的链式查询对象，见Query
+        '''
+        return Query(cls)
+
+    @classmethod
+    def seek(cls, cursor=None, limit=20, backward=False):
+        '''
+        按create_at降序（新的在前）的keyset分页，见Query.seek
+        '''
+        return Query(cls).seek(cursor, limit, backward)
+
+    @classmethod
+    def find_first(cls, where, *args, **kw):
         '''
         通过where语句查询，返回一个查询结果，如果有多个结果，仅取第一个，如果没有结果则返回第一个
+        分片的Model可以用shard指定分片键的值，否则在所有分片上查询；fields见find_by
         '''
-        d = db.select_one('select * from %s %s' % (cls.__table__, where), *args)
-        return cls(**d) if d else None
+        shard = kw.get('shard')
+        sql = 'select %s from `%s` %s' % (cls._columns(kw.get('fields')), cls.__table__, where)
+        d = cls._cached('one', shard, sql, args, lambda: cls._select_one(shard, sql, *args))
+        return cls._load(d) if d else None
 
     @classmethod
-    def find_all(cls, *args):
+    def find_all(cls, *args, **kw):
         '''
         查询所有字段，将结果以一个列表返回
+        可选参数prefetch，需要一起加载的关联对象列表，见prefetch
         '''
-        L = db.select('select * from `%s`' % cls.__table__)
-        return [cls(**d) for d in L]
+        shard = kw.get('shard')
+        sql = 'select %s from `%s`' % (cls._columns(kw.get('fields')), cls.__table__)
+        L = cls._cached('all', shard, sql, (), lambda: cls._select(shard, sql))
+        return cls.prefetch([cls._load(d) for d in L], *kw.get('prefetch', ()))
 
     @classmethod
-    def find_by(cls, where, *args):
+    def find_by(cls, where, *args, **kw):
         '''
         将通过where语句但条件查询，但是返回的结果是以列表返回
+        可选参数prefetch，例如 Comment.find_by('where blog_id=?', blog_id, prefetch=['user'])
+        分片的Model可以用shard指定分片键的值，否则在所有分片上并行查询，结果按分片的顺序合并
+        可选参数fields，只加载这些字段（以及主键），例如 Blog.find_by('where ...', fields=['name', 'summary'])
+        没有加载的字段在访问时再查询，也可以用undefer批量加载
+        '''
+        shard = kw.get('shard')
+        sql = 'select %s from `%s` %s' % (cls._columns(kw.get('fields')), cls.__table__, where)
+        L = cls._cached('all', shard, sql, args, lambda: cls._select(shard, sql, *args))
+        return cls.prefetch([cls._load(d) for d in L], *kw.get('prefetch', ()))
+
+    @classmethod
+    def iter_all(cls, batch_size=500, shard=None, fields=None):
+        '''
+        流式遍历整张表，每次取batch_size行，逐个返回实例，内存占用不随表的大小增长
+        '''
+        return cls._iter(shard, batch_size, 'select %s from `%s`' % (cls._columns(fields), cls.__table__))
+
+    @classmethod
+    def iter_by(cls, where, *args, **kw):
+        '''
+        和find_by一样通过where语句查询，但是以生成器的方式逐个返回实例
+        可选参数batch_size，每次从数据库读取的行数
+        '''
+        return cls._iter(kw.get('shard'), kw.get('batch_size', 500), 'select %s from `%s` %s' % (cls._columns(kw.get('fields')), cls.__table__, where), *args)
+
+    @classmethod
+    def _iter(cls, shard, batch_size, sql, *args):
         '''
-        L = db.select('select * from `%s` %s' % (cls.__table__, where), *args)
-        return [cls(**d) for d in L]
+        分片的Model依次遍历每个分片，每个分片单独借一个连接，不切换当前线程的engine
+        '''
+        router = cls._shard_router()
+        if router is None:
+            names = [None]
+        elif shard is not None:
+            names = [router.shard_for(shard)]
+        else:
+            names = router.names
+        for name in names:
+            for d in db.iter_select(sql, *args, batch_size=batch_size, using=name, compact=True):
+                yield cls._load(d)
 
     @classmethod
-    def count_all(cls):
+    def count_all(cls, shard=None):
         '''
         执行select count(pk) from table语句，返回一个数值
         '''
-        return db.select_int('select count(`%s`) from `%s`' % (cls.__primary_key__.name, cls.__table__))
+        if '*' in cls.__counters__:
+            return cls.count_of('*', shard=shard)
+        sql = 'select count(`%s`) from `%s`' % (cls.__primary_key__.name, cls.__table__)
+        return sum(cls._on_shards(lambda: db.select_int(sql), shard))
 
     @classmethod
-    def count_by(cls, where, *args):
+    def count_by(cls, where, *args, **kw):
         '''
         执行select count(pk) from table where...语句进行查询，返回一个数值
+        条件是 where field=? 并且field有计数器时直接读计数器
         '''
-        return db.select_int('select count(`%s`) from `%s` %s' % (cls.__primary_key__.name, cls.__table__, where), *args)
+        m = _COUNT_WHERE.match(where) if cls.__counters__ and len(args) == 1 else None
+        if m and m.group(1) in cls.__counters__:
+            return cls.count_of(m.group(1), args[0], kw.get('shard'))
+        sql = 'select count(`%s`) from `%s` %s' % (cls.__primary_key__.name, cls.__table__, where)
+        shard = kw.get('shard')
+        return cls._cached('count', shard, sql, args, lambda: sum(cls._on_shards(lambda: db.select_int(sql, *args), shard)))
+
+    #异步版本，在db的异步线程池中执行，立即返回AsyncResult，见db.submit
+    @classmethod
+    def aget(cls, pk, **kw):
+        return db.submit(cls.get, pk, **kw)
+
+    @classmethod
+    def afind_first(cls, where, *args, **kw):
+        return db.submit(cls.find_first, where, *args, **kw)
+
+    @classmethod
+    def afind_by(cls, where, *args, **kw):
+        return db.submit(cls.find_by, where, *args, **kw)
+
+    @classmethod
+    def acount_by(cls, where, *args, **kw):
+        return db.submit(cls.count_by, where, *args, **kw)
 
     def update(self):
-        self.pre_updata and self.pre_updata()
-        L = []
-        args = []
-        for k, v in self.__mappings__.iteritems():
-            if v.updatable:
-                if hasattr(self, k):
-                    arg = getattr(self, k)
-                else:
-                    arg = v.defualt
-                    setattr(self, k, arg)
-                L.append('`%s`=?' % k)
-                args.append(arg)
-        pk = self.__primary_key__.name
-        args.append(getattr(self, pk))
-        db.update('updata `%s` set %s where %s=?' % (self.__table__, ','.join(L), pk), *args)
+        '''
+        从数据库加载的实例只更新修改过的字段，没有修改时不执行sql
+        新建的实例更新所有updatable的字段
+        在session()中只登记，提交事务前统一执行
+        '''
+        self.pre_update and self.pre_update()
+        uow = _session_ctx.uow
+        if uow is not None:
+            uow.add('update', self)
+            return self
+        deltas = self._moved_counts()
+        sql, args = self._update_statement()
+        if sql is None:
+            return self
+        with self._scope():
+            with self._counting():
+                db.update(sql, *args)
+                self._bump(deltas)
+        self._reset_changes()
+        self._invalidate()
         return self
 
+    def _moved_counts(self, deltas=None):
+        '''
+        修改了计数的分组字段时，原来的分组减一，新的分组加一
+        '''
+        if deltas is None:
+            deltas = {}
+        changed = self._changed
+        if changed:
+            for f in self.__counters__:
+                if f in changed and changed[f] is not _MISSING:
+                    old, new = _counter_value(changed[f]), _counter_value(getattr(self, f))
+                    if old != new:
+                        deltas[(f, old)] = deltas.get((f, old), 0) - 1
+                        deltas[(f, new)] = deltas.get((f, new), 0) + 1
+        return deltas
+
+    def _update_statement(self):
+        '''
+        返回update需要执行的(sql, args)，没有需要更新的字段时返回(None, None)
+        '''
+        changed = self._changed
+        if changed is None:
+            fields, sql = self.__update_fields__, self.__update_sql__
+        else:
+            fields = tuple([(k, v) for k, v in self.__update_fields__ if k in changed])
+            sql = self._partial_update_sql(fields)
+        if sql is None:
+            return None, None
+        args = []
+        for k, v in fields:
+            if self._has(k):
+                arg = getattr(self, k)
+            else:
+                arg = v.default
+                setattr(self, k, arg)
+            args.append(arg)
+        args.append(getattr(self, self.__primary_key__.name))
+        return sql, args
+
+    @classmethod
+    def _partial_update_sql(cls, fields):
+        '''
+        只更新部分字段的update语句，按字段组合缓存
+        '''
+        if not fields:
+            return None
+        key = tuple([k for k, v in fields])
+        sql = cls.__partial_update_sql__.get(key)
+        if sql is None:
+            sql = db.compile_sql('update `%s` set %s where `%s`=?' % (cls.__table__, ','.join(['`%s`=?' % v.name for k, v in fields]), cls.__primary_key__.name))
+            cls.__partial_update_sql__[key] = sql
+        return sql
+
     def delete(self):
-        self.pre_delete and self.delete()
-        pk = self.__primary_key__.name
-        args = (getattr(self, pk), )
-        db.update('delete from `%s` where `%s`=?' % (self.__table__, pk), *args)
+        self.pre_delete and self.pre_delete()
+        uow = _session_ctx.uow
+        if uow is not None:
+            uow.add('delete', self)
+            return self
+        with self._scope():
+            with self._counting():
+                if db.update(self.__delete_sql__, getattr(self, self.__primary_key__.name)):
+                    self._bump(self._count_deltas([self], -1))
+        self._invalidate(deleted=True)
         return self
 
     def insert(self):
         '''
-        通过db对象的insert接口执行sql
-        SQL ：insert into ‘user’ （'password'）
+        通过metaclass预先生成的insert语句执行sql
+        SQL ：insert into `user` (`id`,`name`,...) values (...)
+        '''
+        self._prepare_insert()
+        uow = _session_ctx.uow
+        if uow is not None:
+            uow.add('insert', self)
+            return self
+        with self._scope():
+            with self._counting():
+                db.update(self.__insert_sql__, *[getattr(self, k) for k, v in self.__insert_fields__])
+                self._bump(self._count_deltas([self], 1))
+        self._reset_changes()
+        return self
+
+    def open_blob(self, field, mode='r', chunk_size=None):
+        '''
+        按块读写一个blob字段，不把整个值放进内存，mode为'r'（_BlobReader）或'w'（_BlobWriter），例如
+            with user.open_blob('avatar', 'w') as w:
+                w.copy_from(open(path, 'rb'))
+            user.open_blob('avatar').copy_to(f)
+        '''
+        if not field in self.__mappings__:
+            raise AttributeError('%s has no field named %s' % (self.__class__.__name__, field))
+        chunk_size = chunk_size or BLOB_CHUNK_SIZE
+        if mode == 'r':
+            return _BlobReader(self, field, chunk_size)
+        if mode == 'w':
+            return _BlobWriter(self, field, chunk_size)
+        raise ValueError('Bad blob mode: %s' % mode)
+
+    def ainsert(self):
+        '''
+        异步执行insert，session()中登记的写操作属于当前线程，所以这里不能在session()中使用
+        '''
+        if _session_ctx.uow is not None:
+            raise db.DBError('ainsert() can not be used in session()')
+        return db.submit(self.insert)
+
+    def aupdate(self):
+        if _session_ctx.uow is not None:
+            raise db.DBError('aupdate() can not be used in session()')
+        return db.submit(self.update)
+
+    def _prepare_insert(self):
+        '''
+        执行pre_insert并补上缺省值
         '''
         self.pre_insert and self.pre_insert()
-        params = {}
-        for k, v in self.__mappings__.iteritems():
-            if v.insertable:
-                if not hasattr(self, k):
-                    setattr(self, k, v.default)
-                params[v.name] = getattr(self, k)
-        db.insert('%s' % self.__table__, **params)
+        for k, v in self.__insert_fields__:
+            if not self._has(k):
+                setattr(self, k, v.default)
+
+    def _insert_params(self):
+        return dict([(v.name, getattr(self, k)) for k, v in self.__insert_fields__])
+
+    @classmethod
+    def _prepare_upserts(cls, instances):
+        '''
+        save/save_many之前调用：从数据库加载的实例（延迟加载或者投影）先批量加载还没有加载的字段，
+        否则冲突时会用缺省值覆盖数据库中的值；行已经不存在时仍然补上缺省值
+        '''
+        loaded = [inst for inst in instances if inst._changed is not None]
+        fields = [k for k, v in cls.__insert_fields__ if [inst for inst in loaded if not inst._has(k)]]
+        if fields:
+            cls.undefer(loaded, *fields)
+        for inst in instances:
+            inst._prepare_insert()
+
+    def save(self):
+        '''
+        insert ... on duplicate key update，主键或唯一键冲突时更新所有updatable的字段
+        一次往返完成"不存在则插入，存在则更新"
+        session()中不登记，先flush已经登记的写操作再执行
+        '''
+        _flush_session()
+        self._prepare_upserts([self])
+        with self._scope():
+            with self._counting():
+                deltas = self._upsert_counts([self])
+                db.update(self.__upsert_sql__, *[getattr(self, k) for k, v in self.__insert_fields__])
+                self._bump(deltas)
+        self._reset_changes()
+        self._invalidate()
+        return self
+
+    @classmethod
+    def _upsert_counts(cls, instances):
+        '''
+        upsert之前查出已经存在的主键，只有新插入的行计数
+        '''
+        if not cls.__counters__:
+            return {}
+        pk = cls.__primary_key__.name
+        pks = [getattr(inst, pk) for inst in instances]
+        existing = set()
+        for i in range(0, len(pks), 500):
+            chunk = pks[i:i+500]
+            existing.update([d[0] for d in db.select('select `%s` from `%s` where `%s` in (%s)' % (pk, cls.__table__, pk, ','.join(['?'] * len(chunk))), *chunk, compact=True)])
+        return cls._count_deltas([inst for inst in instances if not getattr(inst, pk) in existing], 1)
+
+    @classmethod
+    def save_many(cls, instances, **kw):
+        '''
+        批量的save，合并成多行的 insert ... on duplicate key update 语句
+        可选参数max_rows/max_bytes见db.insert_many
+        '''
+        _flush_session()
+        instances = list(instances)
+        cls._prepare_upserts(instances)
+        r = 0
+        for scope, L in cls._group_by_shard(instances):
+            with scope:
+                with cls._counting():
+                    deltas = cls._upsert_counts(L)
+                    r = r + db.upsert_many(cls.__table__, cls.__upsert_keys__, [inst._insert_params() for inst in L], **kw)
+                    cls._bump(deltas)
+        for inst in instances:
+            inst._reset_changes()
+            inst._invalidate()
+        return r
+
+    @classmethod
+    def update_where(cls, values, where, *args, **kw):
+        '''
+        一条 update ... where 语句更新所有满足条件的行，不加载实例，也不执行pre_update
+        values是字段名到新值的dict，例如
+            Comment.update_where({'user_name': name}, 'where user_id=?', uid)
+        返回影响的行数，分片的Model可以用shard指定分片键的值，否则在所有分片上执行
+        '''
+        if not where.strip():
+            raise ValueError('update_where() requires a where clause')
+        _flush_session()
+        cols, vals = [], []
+        for k, v in values.iteritems():
+            field = cls.__mappings__.get(k)
+            if field is None or not field.updatable:
+                raise AttributeError('%s has no updatable field named %s' % (cls.__name__, k))
+            cols.append('`%s`=?' % field.name)
+            vals.append(v)
+        if not cols:
+            return 0
+        sql = 'update `%s` set %s %s' % (cls.__table__, ','.join(cols), where)
+        moved = [k for k in values if k in cls.__counters__]
+        if moved:
+            def update():
+                #被修改的分组字段：原来的分组减去，新的值加上同样的行数
+                with db.transaction():
+                    before = cls._grouped_counts(where, *args)
+                    deltas = {}
+                    for (f, v), n in before.iteritems():
+                        if f in moved:
+                            new = _counter_value(values[f])
+                            deltas[(f, v)] = deltas.get((f, v), 0) - n
+                            deltas[(f, new)] = deltas.get((f, new), 0) + n
+                    r = db.update(sql, *(vals + list(args)))
+                    cls._bump(deltas)
+                    return r
+            r = sum(cls._on_shards(update, kw.get('shard')))
+        else:
+            r = cls._update_on_shards(kw.get('shard'), sql, *(vals + list(args)))
+        cls._invalidate_all()
+        return r
+
+    @classmethod
+    def delete_where(cls, where, *args, **kw):
+        '''
+        一条 delete ... where 语句删除所有满足条件的行，不执行pre_delete，返回删除的行数
+        '''
+        if not where.strip():
+            raise ValueError('delete_where() requires a where clause')
+        _flush_session()
+        r = cls._delete_counted(kw.get('shard'), where, *args)
+        cls._invalidate_all()
+        return r
+
+    @classmethod
+    def delete_many(cls, pks, chunk_size=500):
+        '''
+        按主键批量删除，每chunk_size个主键一条 delete ... where pk in (...)，返回删除的行数
+        '''
+        _flush_session()
+        pks = list(set(pks))
+        pk_name = cls.__primary_key__.name
+        r = 0
+        for i in range(0, len(pks), chunk_size):
+            chunk = pks[i:i+chunk_size]
+            r = r + cls._delete_counted(None, 'where `%s` in (%s)' % (pk_name, ','.join(['?'] * len(chunk))), *chunk)
+        imap = db.identity_map()
+        if imap is not None:
+            for pk in pks:
+                imap.pop((cls, pk), None)
+        cache = cls.__cache__
+        if cache is not None:
+            def invalidate(committed):
+                for pk in pks:
+                    cache.invalidate(pk)
+            invalidate(True)
+            db.after_transaction(invalidate)
+        return r
+
+    @classmethod
+    def _delete_counted(cls, shard, where, *args):
+        '''
+        delete ... where，有计数器时先在同一个事务中统计要删除的行，再从计数器中减去
+        '''
+        sql = 'delete from `%s` %s' % (cls.__table__, where)
+        if not cls.__counters__:
+            return cls._update_on_shards(shard, sql, *args)
+        def delete():
+            with db.transaction():
+                deltas = cls._grouped_counts(where, *args)
+                r = db.update(sql, *args)
+                cls._bump(dict([(k, -n) for k, n in deltas.iteritems()]))
+                return r
+        return sum(cls._on_shards(delete, shard))
+
+    @classmethod
+    def _invalidate_all(cls):
+        '''
+        不知道具体影响了哪些行时，清掉这个类在identity map和LRU缓存中的所有实例
+        '''
+        imap = db.identity_map()
+        if imap is not None:
+            for key in [key for key in imap if key[0] is cls]:
+                del imap[key]
+        cache = cls.__cache__
+        if cache is not None:
+            cache.clear()
+            db.after_transaction(lambda committed: cache.clear())
+
+    @classmethod
+    def insert_many(cls, instances, **kw):
+        '''
+        批量插入，对每个实例执行pre_insert并补上缺省值，然后合并成多行insert语句
+        可选参数max_rows/max_bytes见db.insert_many，返回插入的总行数
+        '''
+        instances = list(instances)
+        for inst in instances:
+            inst._prepare_insert()
+        r = 0
+        for scope, L in cls._group_by_shard(instances):
+            with scope:
+                with cls._counting():
+                    r = r + db.insert_many(cls.__table__, [inst._insert_params() for inst in L], **kw)
+                    cls._bump(cls._count_deltas(L, 1))
+        for inst in instances:
+            inst._reset_changes()
+        return r
+
+class _Record(object):
+    '''
+    __compact__ = True 的Model的基类（由ModelMetalclass替换掉Model），字段保存在__slots__中，
+    每个实例只占几个指针的内存，没有dict的哈希表。从查询结果的tuple按列的顺序直接填充
+    ORM的方法和Model共用；仍然支持 r['name']、keys()/items()、in 等dict风格的访问
+    实例不是dict（也不是Model的实例），json序列化前先调用to_dict()
+        class Comment(Model):
+            __compact__ = True
+            ...
+    '''
+    __slots__ = ('_changed',)
+
+    def __init__(self, **kw):
+        object.__setattr__(self, '_changed', None)
+        for k, v in kw.iteritems():
+            if not k in self.__mappings__:
+                raise AttributeError('%s has no field named %s' % (self.__class__.__name__, k))
+            object.__setattr__(self, k, v)
+
+    @classmethod
+    def _load(cls, d):
+        inst = cls.__new__(cls)
+        object.__setattr__(inst, '_changed', {})
+        mappings = cls.__mappings__
+        if isinstance(d, db.Row):
+            items = itertools.izip(d._names, tuple.__iter__(d))
+        else:
+            items = d.iteritems()
+        for k, v in items:
+            if k in mappings:
+                object.__setattr__(inst, k, v)
+        return inst
+
+    def __getitem__(self, key):
+        if key in self.__mappings__:
+            try:
+                return object.__getattribute__(self, key)
+            except AttributeError:
+                pass
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if not key in self.__mappings__:
+            raise KeyError(key)
+        if self._changed is not None:
+            try:
+                old = object.__getattribute__(self, key)
+            except AttributeError:
+                old = _MISSING
+            self._track(key, old, value)
+        object.__setattr__(self, key, value)
+
+    def _set_loaded(self, key, value):
+        object.__setattr__(self, key, value)
+
+    def _unload(self, key):
+        try:
+            object.__delattr__(self, key)
+        except AttributeError:
+            pass
+
+    def __delitem__(self, key):
+        try:
+            object.__delattr__(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def iteritems(self):
+        for k in self.__fields__:
+            try:
+                yield k, object.__getattribute__(self, k)
+            except AttributeError:
+                pass
+
+    def iterkeys(self):
+        return (k for k, v in self.iteritems())
+
+    def itervalues(self):
+        return (v for k, v in self.iteritems())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def __iter__(self):
+        return self.iterkeys()
+
+    def __len__(self):
+        return len(self.items())
+
+    def _has(self, key):
+        if not key in self.__mappings__:
+            return False
+        try:
+            object.__getattribute__(self, key)
+            return True
+        except AttributeError:
+            return False
+
+    __contains__ = has_key = _has
+
+    def to_dict(self):
+        return dict(self.iteritems())
+
+    def __eq__(self, other):
+        if isinstance(other, _Record):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join(['%s=%r' % kv for kv in self.iteritems()]))
+
+#_Record和Model共用ORM的方法，只有字段的存储方式不同
+for _k, _v in Model.__dict__.items():
+    if not _k in _Record.__dict__ and not _k in ('__dict__', '__weakref__', '__doc__', '__module__', '_changed'):
+        setattr(_Record, _k, _v)
+del _k, _v
+
+#blob每次读写的字节数
+BLOB_CHUNK_SIZE = 64 * 1024
+
+class _BlobReader(object):
+    '''
+    按块读取blob字段，每块一条 select substring(col, pos, n)，每次查询单独借连接，
+    遍历得到每一块的数据，readinto/copy_to把数据直接放进调用方的缓冲区或文件
+    '''
+    def __init__(self, inst, field, chunk_size):
+        cls = inst.__class__
+        self._inst = inst
+        self._pk = getattr(inst, cls.__primary_key__.name)
+        self._sql = 'select %%s from `%s` where `%s`=?' % (cls.__table__, cls.__primary_key__.name)
+        self.column = cls.__mappings__[field].name
+        self.chunk_size = chunk_size
+
+    def _select(self, expr, *args):
+        with self._inst._scope():
+            d = db.select_one(self._sql % expr, *(args + (self._pk,)), compact=True)
+        return None if d is None else d[0]
+
+    def length(self):
+        '''
+        blob的字节数，行不存在或者值为null时返回None
+        '''
+        return self._select('length(`%s`)' % self.column)
+
+    def read(self, pos, size):
+        return self._select('substring(`%s`, ?, ?)' % self.column, pos + 1, size)
+
+    def chunks(self, start=0):
+        pos = start
+        while True:
+            data = self.read(pos, self.chunk_size)
+            if not data:
+                break
+            yield data
+            if len(data) < self.chunk_size:
+                break
+            pos = pos + len(data)
+
+    def __iter__(self):
+        return self.chunks()
+
+    def readinto(self, buf, start=0):
+        '''
+        从start开始读满buf（bytearray或memoryview），返回读到的字节数
+        '''
+        view = memoryview(buf)
+        n = 0
+        while n < len(view):
+            size = min(self.chunk_size, len(view) - n)
+            data = self.read(start + n, size)
+            if not data:
+                break
+            view[n:n+len(data)] = data
+            n = n + len(data)
+            if len(data) < size:
+                break
+        return n
+
+    def copy_to(self, fileobj):
+        '''
+        把整个blob按块写进fileobj，返回写入的字节数
+        '''
+        n = 0
+        for data in self.chunks():
+            fileobj.write(data)
+            n = n + len(data)
+        return n
+
+class _BlobWriter(object):
+    '''
+    按块写入blob字段：第一块 set col=?，以后每块 set col=concat(col, ?)
+    所有块在同一个事务中执行，close()时提交，出错（或者在with中抛出异常）时回滚，
+    数据库中不会留下写了一半的值
+    '''
+    def __init__(self, inst, field, chunk_size):
+        cls = inst.__class__
+        self._inst = inst
+        self._field = field
+        self._pk = getattr(inst, cls.__primary_key__.name)
+        column = cls.__mappings__[field].name
+        where = 'where `%s`=?' % cls.__primary_key__.name
+        self._first_sql = db.compile_sql('update `%s` set `%s`=? %s' % (cls.__table__, column, where))
+        self._append_sql = db.compile_sql('update `%s` set `%s`=concat(`%s`, ?) %s' % (cls.__table__, column, column, where))
+        self.chunk_size = chunk_size
+        self.written = 0
+        self.closed = False
+        self._buf = bytearray()
+        self._scope = inst._scope()
+        self._scope.__enter__()
+        self._txn = db.transaction()
+        self._txn.__enter__()
+
+    def _flush(self, data):
+        r = db.update(self._append_sql if self.written else self._first_sql, memoryview(data).tobytes(), self._pk)
+        #mysql的rowcount不包括值没有变化的行，所以为0时再确认一下行是否存在
+        if r == 0 and not self.written and _BlobReader(self._inst, self._field, 1).length() is None:
+            raise db.DBError('%s(%s) does not exist' % (self._inst.__class__.__name__, self._pk))
+        self.written = self.written + len(data)
+
+    def write(self, data):
+        '''
+        data可以是str、bytearray或memoryview，攒够chunk_size时写入一块
+        '''
+        if self.closed:
+            raise ValueError('write to closed blob')
+        self._buf += data
+        while len(self._buf) >= self.chunk_size:
+            self._flush(memoryview(self._buf)[:self.chunk_size])
+            del self._buf[:self.chunk_size]
+
+    def copy_from(self, fileobj):
+        '''
+        用同一个bytearray缓冲区从fileobj（需要支持readinto）读取并写入，返回写入的字节数
+        '''
+        buf = bytearray(self.chunk_size)
+        view = memoryview(buf)
+        n = 0
+        while True:
+            size = fileobj.readinto(buf)
+            if not size:
+                break
+            self.write(view[:size])
+            n = n + size
+        return n
+
+    def close(self):
+        if self.closed:
+            return
+        self._finish(None, None, None)
+
+    def _finish(self, type, value, trace):
+        self.closed = True
+        try:
+            if type is None and (self._buf or not self.written):
+                self._flush(self._buf)
+        except:
+            type, value, trace = sys.exc_info()
+            self._exit(type, value, trace)
+            raise type, value, trace
+        self._exit(type, value, trace)
+
+    def _exit(self, type, value, trace):
+        try:
+            self._txn.__exit__(type, value, trace)
+        finally:
+            self._scope.__exit__(type, value, trace)
+            self._buf = None
+            self._inst._unload(self._field)
+            self._inst._invalidate()
+
+    def __enter__(self):
         return self
 
+    def __exit__(self, type, value, trace):
+        if not self.closed:
+            self._finish(type, value, trace)
+
+def blob_response(inst, field, start_response, content_type='application/octet-stream', headers=(), chunk_size=None):
+    '''
+    WSGI辅助函数，把实例的blob字段按块直接写到响应中，不在内存中拼出整个值，例如
+        def avatar(environ, start_response):
+            user = User.get(user_id, fields=['id'])
+            return orm.blob_response(user, 'avatar', start_response, 'image/png')
+    行不存在或者值为null时返回404
+    '''
+    reader = inst.open_blob(field, 'r', chunk_size)
+    length = reader.length()
+    if length is None:
+        start_response('404 Not Found', [('Content-Type', 'text/plain')])
+        return ['Not Found']
+    start_response('200 OK', [('Content-Type', content_type), ('Content-Length', str(length))] + list(headers))
+    return reader
+
+#同一行先后登记的操作合并成一个：(原操作, 新操作) --> 合并后的操作，None表示互相抵消
+_MERGE_OPS = {
+    ('insert', 'update'): 'insert',
+    ('insert', 'delete'): None,
+    ('update', 'delete'): 'delete',
+    ('delete', 'insert'): 'replace',
+    ('delete', 'update'): 'delete',
+    ('replace', 'update'): 'replace',
+    ('replace', 'delete'): 'delete',
+}
+
+#这些组合在数据库中会主键冲突，登记时直接报错，不能让后一个实例覆盖前一个
+_CONFLICT_OPS = set([('insert', 'insert'), ('update', 'insert'), ('replace', 'insert')])
+
+class _UnitOfWork(object):
+    '''
+    session中登记的insert/update/delete，在事务提交前按表分组批量执行：
+    每张表先delete（where pk in (...)），再多行insert，最后按字段组合executemany执行update
+    '''
+    def __init__(self):
+        self._pending = OrderedDict() #(类, 主键) --> [操作, 实例]
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, op, inst):
+        cls = inst.__class__
+        pk = getattr(inst, cls.__primary_key__.name, None)
+        key = (cls, pk if pk is not None else id(inst))
+        item = self._pending.get(key)
+        if item is None:
+            self._pending[key] = [op, inst]
+            return
+        if (item[0], op) in _CONFLICT_OPS:
+            raise db.DBError('Duplicate insert of %s(%s) in session, the row is already pending as %s' % (cls.__name__, pk, item[0]))
+        merged = _MERGE_OPS.get((item[0], op), op)
+        if merged is None:
+            del self._pending[key]
+        else:
+            item[0], item[1] = merged, inst
+
+    def clear(self):
+        self._pending.clear()
+
+    def flush(self):
+        '''
+        执行所有登记的操作，必须在事务中调用
+        '''
+        tables = OrderedDict()
+        for (cls, pk), (op, inst) in self._pending.iteritems():
+            tables.setdefault(cls, []).append((op, inst))
+        self._pending.clear()
+        for cls, items in tables.iteritems():
+            #分片的Model在各自的分片上执行，各分片的事务随外层事务一起提交或回滚（见db.using）
+            for scope, L in cls._group_by_shard(items, operator.itemgetter(1)):
+                with scope:
+                    self._flush_table(cls, L)
+
+    def _flush_table(self, cls, items):
+        '''
+        同一张表按delete、insert、update的顺序批量执行
+        '''
+        pk_name = cls.__primary_key__.name
+        deletes = [inst for op, inst in items if op in ('delete', 'replace')]
+        inserts = [inst for op, inst in items if op in ('insert', 'replace')]
+        updates = [inst for op, inst in items if op == 'update']
+        deltas = {}
+        for i in range(0, len(deletes), 500):
+            chunk = [getattr(inst, pk_name) for inst in deletes[i:i+500]]
+            where = 'where `%s` in (%s)' % (pk_name, ','.join(['?'] * len(chunk)))
+            if cls.__counters__:
+                #和delete_where一样只减去实际存在的行，已经不存在的行不计数
+                for k, n in cls._grouped_counts(where, *chunk).iteritems():
+                    deltas[k] = deltas.get(k, 0) - n
+            db.update('delete from `%s` %s' % (cls.__table__, where), *chunk)
+        if cls.__counters__:
+            cls._count_deltas(inserts, 1, deltas)
+            for inst in updates:
+                inst._moved_counts(deltas)
+            cls._bump(deltas)
+        for inst in deletes:
+            inst._invalidate(deleted=True)
+        if inserts:
+            db.insert_many(cls.__table__, [inst._insert_params() for inst in inserts])
+            for inst in inserts:
+                inst._reset_changes()
+        statements = OrderedDict()
+        for inst in updates:
+            sql, args = inst._update_statement()
+            if sql is not None:
+                statements.setdefault(sql, []).append(args)
+                inst._reset_changes()
+                inst._invalidate()
+        for sql, args_list in statements.iteritems():
+            db.update_many(sql, args_list)
+
+class _SessionLocal(threading.local):
+    '''
+    当前线程的unit of work，只在session()中存在
+    '''
+    def __init__(self):
+        self.uow = None
+
+_session_ctx = _SessionLocal()
+
+def _flush_session():
+    '''
+    update_where/delete_where/save这类直接执行的语句之前，先执行session中登记的写操作，保持先后顺序
+    '''
+    uow = _session_ctx.uow
+    if uow is not None:
+        uow.flush()
+
+class _SessionCtx(object):
+    '''
+    开启（或加入）一个事务，并在事务上绑定unit of work
+    事务提交前flush登记的写操作，回滚时丢弃
+    '''
+    def __enter__(self):
+        self._txn = db.transaction()
+        self._txn.__enter__()
+        uow = _session_ctx.uow
+        if uow is None:
+            uow = _session_ctx.uow = _UnitOfWork()
+            db.before_commit(uow.flush)
+            db.after_transaction(self._unbind)
+        return uow
+
+    @staticmethod
+    def _unbind(committed):
+        uow, _session_ctx.uow = _session_ctx.uow, None
+        if uow is not None:
+            uow.clear()
+
+    def __exit__(self, type, value, trace):
+        return self._txn.__exit__(type, value, trace)
+
+def session():
+    '''
+    orm的unit of work，用法：
+        with session():
+            blog.insert()
+            comment.update()
+    session中的insert/update/delete先登记，同一行的多次操作合并，事务提交前按表批量执行
+    update_where/delete_where/delete_many/save/save_many不登记，执行之前先flush已经登记的操作
+    需要读到登记的修改时先调用session的flush()
+    '''
+    return _SessionCtx()
+
 # if __name__ == '__main__':
 #     logging.basicConfig(level=logging.DEBUG)
 #     db.create_engine('root', '123456', 'test', '192.168.37.152')